@@ -5,42 +5,30 @@ class OrderController:
     def __init__(self, db):
         self.model = OrderModel(db)
 
-    def create_new_order(self, client_id, delivery_address, items):
-        if not isinstance(client_id, int):
-            print(f"Ошибка: client_id должен быть числом, получено {type(client_id)}")
-            return None
-        if not client_id:
-            print("Ошибка: не указан client_id")
-            return None
-
+    def place_order(self, client_id, name, surname, email, phone, delivery_address, items):
+        """
+        Оформление заказа за один обмен с сервером. Возвращает словарь с order_id,
+        client_id, данными заказа (order_info) и товарами (items) в форматах
+        get_order_info и get_order_items или None при ошибке
+        """
         if not items:
             print("Ошибка: пустой список товаров")
             return None
 
-        try:
-            total = sum(item['price'] * item['quantity'] for item in items)
-            print(f"Создание заказа для client_id={client_id}, total={total}")
-
-            order_result = self.model.create_order(client_id, delivery_address, total)
-
-            if not order_result:
-                print("Ошибка при создании заказа")
-                return None
-
-            order_id = order_result[0][0]
-            print(f"Заказ создан, ID: {order_id}")
-
-            for item in items:
-                print(f"Добавление товара {item['id']}, количество: {item['quantity']}")
-                if not self.model.add_item_to_order(order_id, item['id'], item['quantity']):
-                    print(f"Ошибка при добавлении товара {item['id']}")
-
-            return order_id
-
-        except Exception as e:
-            print(f"Исключение при создании заказа: {str(e)}")
+        rows = self.model.place_order(client_id, name, surname, email, phone, delivery_address, items)
+        if not rows:
+            print("Ошибка при оформлении заказа")
             return None
 
+        order_id, client_id, name, surname, total, address, status = rows[0][:7]
+        print(f"Заказ создан, ID: {order_id}")
+        return {
+            'order_id': order_id,
+            'client_id': client_id,
+            'order_info': (order_id, name, surname, total, address, status),
+            'items': [row[7:] for row in rows],
+        }
+
     def get_filtered_orders(self, filters):
         return self.model.get_filtered_orders(
             filters.get('date'),
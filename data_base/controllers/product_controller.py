@@ -1,15 +1,22 @@
 from models.product_model import ProductModel
 
 class ProductController:
-    def __init__(self, db):
+    def __init__(self, db, catalog):
         self.model = ProductModel(db)
+        # Общий на приложение кэш товаров (см. main.py); изменения с других рабочих мест приходят через NOTIFY
+        self.catalog = catalog
 
     def get_available_products(self):
-        return self.model.get_available_products()
+        return self.catalog.products()
 
     def get_product_id_by_name(self, name):
-        result = self.model.get_product_by_name(name)
-        return result[0][0] if result else None
+        product = self.catalog.get_by_name(name)
+        return product[0] if product else None
 
-    def update_product_stock(self, product_id, quantity):
-        return self.model.update_stock(product_id, quantity)
\ No newline at end of file
+    def catalog_version(self):
+        """Номер версии кэша товаров: меняется при каждом сбросе, в том числе по NOTIFY"""
+        return self.catalog.version
+
+    def invalidate_catalog(self):
+        """Сброс кэша после изменения остатков (например, после оформления заказа)"""
+        self.catalog.invalidate()
\ No newline at end of file
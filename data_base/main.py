@@ -1,20 +1,33 @@
 import sys
 from PyQt5.QtWidgets import QApplication
 from models.database import Database
+from models.order_model import OrderModel
+from models.product_catalog import ProductCatalog
+from models.product_model import ProductModel
 from views.client_order_form import ClientOrderForm
 
 
 def create_connection():
-    db = Database()
+    # Пул соединений: окна и фоновые задачи получают каждое своё соединение
+    db = Database(minconn=1, maxconn=10)
     if not db.connect("LAB1", "postgres", "123"):
         print("Не удалось подключиться к базе данных")
         return None
 
-    # Добавляем тест соединения сразу после подключения
-    if not db.test_connection():
+    # Проверяем пул сразу после подключения
+    if not db.health_check():
         print("Тест соединения с БД не пройден")
         return None
 
+    # Серверная функция оформления заказа создаётся один раз скриптом setup_database.py
+    if not OrderModel(db).has_place_order():
+        print("В базе нет функции place_order: выполните python setup_database.py")
+        return None
+
+    # Уведомления об изменениях товаров для кэша каталога (без них кэш сбрасывается только локально)
+    if not ProductModel(db).has_item_trigger():
+        print("В базе нет триггера item_changed: каталог не увидит изменения с других рабочих мест")
+
     return db
 
 
@@ -26,8 +39,15 @@ if __name__ == "__main__":
     if not db_connection:
         sys.exit(1)
 
+    # Один кэш товаров и одна подписка на item_changed на всё приложение
+    catalog = ProductCatalog(ProductModel(db_connection))
+    catalog.start_listening(db_connection)
+
     # Создаем и показываем форму только если подключение успешно
-    window = ClientOrderForm(db_connection)
+    window = ClientOrderForm(db_connection, catalog)
     window.show()
 
-    sys.exit(app.exec_())
\ No newline at end of file
+    exit_code = app.exec_()
+    catalog.stop_listening()
+    db_connection.close()
+    sys.exit(exit_code)
\ No newline at end of file
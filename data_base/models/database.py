@@ -1,49 +1,179 @@
+import threading
+from contextlib import contextmanager
+
 import psycopg2
-from psycopg2 import sql
+from psycopg2 import pool, sql
+
+
+class Transaction:
+    """
+    Единица работы: все запросы выполняются на одном соединении и
+    фиксируются одним коммитом при выходе из Database.transaction().
+    Повторяет интерфейс Database, поэтому модели работают с ней так же,
+    но ошибка запроса не глотается, а откатывает всю транзакцию.
+    """
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute_query(self, query, params=None, fetch=False, autocommit=False):
+        # autocommit не действует: команда фиксируется вместе со всей транзакцией
+        self.cursor.execute(query, params or ())
+        return self.cursor.fetchall() if fetch else True
+
+    @contextmanager
+    def transaction(self):
+        """Вложенная транзакция присоединяется к внешней"""
+        yield self
 
 
 class Database:
-    def __init__(self):
-        self.conn = None
-        self.cursor = None
+    """
+    Пул соединений с PostgreSQL. Каждая операция получает из пула своё
+    соединение и курсор, поэтому окна и фоновые задачи не ждут друг друга
+    на одном курсоре, а ошибка одного запроса откатывает только его работу.
+    """
+
+    def __init__(self, minconn=1, maxconn=10, acquire_timeout=30):
+        self.pool = None
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.acquire_timeout = acquire_timeout  # Сколько секунд ждать свободное соединение
+        self._slots = None
+        self._connect_params = None
 
     def connect(self, dbname, user, password, host='localhost', port='5432'):
         try:
-            self.conn = psycopg2.connect(
-                dbname=dbname,
-                user=user,
-                password=password,
-                host=host,
-                port=port
-            )
-            self.cursor = self.conn.cursor()
+            self._connect_params = dict(dbname=dbname, user=user, password=password, host=host, port=port)
+            self.pool = pool.ThreadedConnectionPool(self.minconn, self.maxconn, **self._connect_params)
+            # ThreadedConnectionPool сразу падает, когда соединения кончились, а семафор заставляет подождать
+            self._slots = threading.BoundedSemaphore(self.maxconn)
             return True
         except Exception as e:
             print(f"Database connection error: {e}")
             return False
 
-    def execute_query(self, query, params=None, fetch=False):
+    @staticmethod
+    def _is_alive(conn):
+        """
+        Проверка соединения запросом SELECT 1: conn.closed выставляется только
+        после неудачной операции, поэтому соединения, закрытые сервером
+        (перезапуск, таймаут простоя), иначе выдавались бы пользователю
+        """
+        if conn.closed:
+            return False
+        try:
+            conn.autocommit = True  # Проверка не открывает транзакцию
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.autocommit = False
+            return True
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            return False
+
+    def _get_connection(self):
+        """Живое соединение из пула: закрытые сервером соединения заменяются новыми"""
+        for _ in range(self.maxconn + 1):
+            conn = self.pool.getconn()
+            if self._is_alive(conn):
+                return conn
+            self.pool.putconn(conn, close=True)
+        raise pool.PoolError("Не удалось получить рабочее соединение из пула")
+
+    @contextmanager
+    def connection(self):
+        """Соединение из пула на время одной операции или транзакции"""
+        if self.pool is None:
+            raise pool.PoolError("Нет подключения к базе данных")
+        if not self._slots.acquire(timeout=self.acquire_timeout):
+            raise pool.PoolError("Нет свободных соединений в пуле")
+
+        conn = None
+        broken = False
         try:
-            self.cursor.execute(query, params or ())
-            result = self.cursor.fetchall() if fetch else None
-            self.conn.commit()  # Всегда делаем коммит
+            conn = self._get_connection()
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            # Соединение могло оборваться: не возвращаем его в пул
+            broken = True
+            raise
+        finally:
+            if conn is not None:
+                # Незавершённая транзакция откатывается пулом при возврате соединения
+                self.pool.putconn(conn, close=broken or bool(conn.closed))
+            self._slots.release()
+
+    @contextmanager
+    def cursor(self, autocommit=False):
+        """
+        Курсор отдельного соединения: коммит при успехе, откат при ошибке.
+        С autocommit=True каждая команда сама себе транзакция и отдельный
+        COMMIT на сервер не отправляется.
+        """
+        with self.connection() as conn:
+            conn.autocommit = autocommit
+            try:
+                with conn.cursor() as cursor:
+                    yield cursor
+                if not autocommit:
+                    conn.commit()
+            except Exception:
+                if not conn.closed and not autocommit:
+                    conn.rollback()
+                raise
+            finally:
+                if not conn.closed:
+                    conn.autocommit = False
+
+    @contextmanager
+    def transaction(self):
+        """
+        Транзакция из нескольких запросов:
+
+            with db.transaction() as tx:
+                tx.execute_query(...)
+                tx.execute_query(...)
+
+        Коммит один раз в конце блока, при исключении откатывается всё.
+        """
+        with self.cursor() as cursor:
+            yield Transaction(cursor)
+
+    def execute_query(self, query, params=None, fetch=False, autocommit=False):
+        """
+        Один запрос в собственной транзакции; ошибки печатаются, а не пробрасываются.
+        autocommit=True экономит обмен с сервером на COMMIT для одиночной команды.
+        """
+        try:
+            with self.cursor(autocommit) as cursor:
+                cursor.execute(query, params or ())
+                result = cursor.fetchall() if fetch else None
             return result if fetch else True
         except Exception as e:
-            self.conn.rollback()
             print(f"Error executing query: {e}")
             return None if fetch else False
 
-    def test_connection(self):
+    def listen(self, channel):
+        """Отдельное от пула соединение, подписанное через LISTEN на канал channel"""
+        conn = psycopg2.connect(**self._connect_params)
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute(sql.SQL("LISTEN {}").format(sql.Identifier(channel)))
+        return conn
+
+    def health_check(self):
+        """Проверка пула: соединение выдаётся и отвечает на запрос"""
         try:
-            self.cursor.execute("SELECT 1")
-            self.conn.commit()
+            with self.cursor() as cursor:
+                cursor.execute("SELECT 1")
+                cursor.fetchone()
             print("Тест подключения: УСПЕШНО")
             return True
         except Exception as e:
             print(f"Тест подключения: ОШИБКА - {e}")
             return False
+
     def close(self):
-        if self.cursor:
-            self.cursor.close()
-        if self.conn:
-            self.conn.close()
\ No newline at end of file
+        if self.pool:
+            self.pool.closeall()
+            self.pool = None
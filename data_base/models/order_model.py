@@ -1,20 +1,31 @@
+from psycopg2.extras import Json
+
+# Сигнатура функции из models/sql/place_order.sql (создаётся setup_database.py)
+PLACE_ORDER_SIGNATURE = 'place_order(integer, text, text, text, text, text, jsonb, text)'
+
+
 class OrderModel:
     def __init__(self, db):
         self.db = db
 
-    def create_order(self, client_id, delivery_address, total, status='обрабатывается'):
-        return self.db.execute_query(
-            "INSERT INTO orders (client_id, delivery_address, total, status, order_date) "
-            "VALUES (%s, %s, %s, %s, NOW()) RETURNING id",
-            (client_id, delivery_address, total, status),
-            fetch=True
-        )
+    def has_place_order(self):
+        """Есть ли в базе серверная функция place_order"""
+        result = self.db.execute_query("SELECT to_regprocedure(%s) IS NOT NULL", (PLACE_ORDER_SIGNATURE,),
+                                       fetch=True)
+        return bool(result and result[0][0])
 
-    def add_item_to_order(self, order_id, item_id, quantity):
+    def place_order(self, client_id, name, surname, email, phone, delivery_address, items):
+        """
+        Клиент, заказ, его строки и списание остатков одним вызовом place_order:
+        один обмен с сервером. Возвращает строки чека
+        (order_id, client_id, name, surname, total, address, status, item_name, quantity, price)
+        """
         return self.db.execute_query(
-            "INSERT INTO check_item (check_id, item_id, quantitity) "
-            "VALUES (%s, %s, %s)",
-            (order_id, item_id, quantity)
+            "SELECT * FROM place_order(%s, %s, %s, %s, %s, %s, %s)",
+            (client_id, name, surname, email, phone, delivery_address,
+             Json([{'id': item['id'], 'quantity': item['quantity']} for item in items])),
+            fetch=True,
+            autocommit=True
         )
 
     def get_filtered_orders(self, date_filter=None, client_filter=None, status_filter=None):
@@ -0,0 +1,82 @@
+import select
+import threading
+
+ITEM_CHANNEL = 'item_changed'  # Канал NOTIFY из models/sql/item_notify.sql
+LISTEN_POLL_SECONDS = 1.0
+
+
+class ProductCatalog:
+    """
+    Кэш доступных товаров в памяти процесса: поиск по id и по названию
+    без запросов к БД. Загружается одним get_available_products при первом
+    обращении и сбрасывается при изменении остатков - локально через
+    invalidate() или по уведомлению item_changed от сервера.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self._lock = threading.Lock()
+        self._by_id = None
+        self._by_name = None
+        self.version = 0  # Растёт при каждом сбросе: по нему окна узнают, что список товаров устарел
+        self._listener = None
+        self._stop = threading.Event()
+
+    def _ensure_loaded(self):
+        with self._lock:
+            if self._by_id is None:
+                products = self.model.get_available_products()
+                if products is None:
+                    return {}, {}  # Ошибка БД: не кэшируем, попробуем в следующий раз
+                self._by_id = {product[0]: product for product in products}
+                self._by_name = {product[1]: product for product in products}
+            return self._by_id, self._by_name
+
+    def products(self):
+        """Список (id, name, price) доступных товаров"""
+        by_id, _ = self._ensure_loaded()
+        return list(by_id.values())
+
+    def get_by_name(self, name):
+        _, by_name = self._ensure_loaded()
+        return by_name.get(name)
+
+    def invalidate(self):
+        with self._lock:
+            self._by_id = None
+            self._by_name = None
+            self.version += 1
+
+    def start_listening(self, db, channel=ITEM_CHANNEL):
+        """Фоновый поток, сбрасывающий кэш по NOTIFY channel (изменения товаров с других рабочих мест)"""
+        try:
+            conn = db.listen(channel)
+        except Exception as e:
+            print(f"Не удалось подписаться на {channel}: {e}")
+            return False
+
+        self._stop.clear()
+        self._listener = threading.Thread(target=self._listen, args=(conn,), daemon=True)
+        self._listener.start()
+        return True
+
+    def _listen(self, conn):
+        try:
+            while not self._stop.is_set():
+                if select.select([conn], [], [], LISTEN_POLL_SECONDS) == ([], [], []):
+                    continue
+                conn.poll()
+                if conn.notifies:
+                    conn.notifies.clear()
+                    self.invalidate()
+        except Exception as e:
+            # Без уведомлений кэш по-прежнему сбрасывается локальными обновлениями остатков
+            print(f"Подписка на изменения товаров прервана: {e}")
+        finally:
+            conn.close()
+
+    def stop_listening(self):
+        self._stop.set()
+        if self._listener is not None:
+            self._listener.join()
+            self._listener = None
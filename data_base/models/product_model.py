@@ -2,21 +2,16 @@ class ProductModel:
     def __init__(self, db):
         self.db = db
 
-    def get_available_products(self):
-        return self.db.execute_query(
-            "SELECT id, name, price FROM item WHERE in_stock > 0",
+    def has_item_trigger(self):
+        """Есть ли триггер item_changed из models/sql/item_notify.sql (создаётся setup_database.py)"""
+        result = self.db.execute_query(
+            "SELECT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'item_changed' AND tgrelid = 'item'::regclass)",
             fetch=True
         )
+        return bool(result and result[0][0])
 
-    def get_product_by_name(self, name):
+    def get_available_products(self):
         return self.db.execute_query(
-            "SELECT id FROM item WHERE name = %s",
-            (name,),
+            "SELECT id, name, price FROM item WHERE in_stock > 0",
             fetch=True
         )
-
-    def update_stock(self, product_id, quantity):
-        return self.db.execute_query(
-            "UPDATE item SET in_stock = in_stock - %s WHERE id = %s",
-            (quantity, product_id)
-        )
\ No newline at end of file
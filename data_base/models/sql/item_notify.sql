@@ -0,0 +1,17 @@
+-- Устанавливается скриптом setup_database.py.
+-- Уведомление item_changed после любого изменения таблицы item: клиенты,
+-- подписанные через LISTEN, сбрасывают кэш каталога товаров.
+CREATE OR REPLACE FUNCTION notify_item_changed()
+RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    PERFORM pg_notify('item_changed', TG_OP);
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS item_changed ON item;
+CREATE TRIGGER item_changed
+AFTER INSERT OR UPDATE OR DELETE ON item
+FOR EACH STATEMENT EXECUTE FUNCTION notify_item_changed();
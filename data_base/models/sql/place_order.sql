@@ -0,0 +1,98 @@
+-- Устанавливается скриптом setup_database.py.
+-- Оформление заказа за один вызов: клиент, заказ, строки заказа и списание
+-- остатков в одной транзакции. Возвращает данные для чека, по строке на товар.
+-- В тексте нет знаков процента: он передаётся в cursor.execute как есть.
+-- p_items: JSON-массив вида [{"id": 1, "quantity": 2}, ...]
+CREATE OR REPLACE FUNCTION place_order(
+    p_client_id integer,
+    p_name text,
+    p_surname text,
+    p_email text,
+    p_phone text,
+    p_address text,
+    p_items jsonb,
+    p_status text DEFAULT 'обрабатывается'
+)
+RETURNS TABLE (
+    order_id integer,
+    client_id integer,
+    client_name text,
+    client_surname text,
+    order_total numeric,
+    order_address text,
+    order_status text,
+    item_name text,
+    item_quantity integer,
+    item_price numeric
+)
+LANGUAGE plpgsql
+AS $$
+#variable_conflict use_column
+DECLARE
+    v_client_id integer;
+    v_order_id integer;
+    v_total numeric;
+    v_lines integer;
+    v_updated integer;
+BEGIN
+    -- Клиент: те же правила, что в ClientController.handle_client_update
+    SELECT c.id INTO v_client_id FROM client c WHERE c.phone = p_phone;
+    IF p_client_id IS NOT NULL THEN
+        IF v_client_id IS NOT NULL AND v_client_id <> p_client_id THEN
+            RAISE EXCEPTION USING MESSAGE = 'Телефон ' || p_phone || ' занят другим клиентом';
+        END IF;
+        UPDATE client c
+        SET name = p_name, surname = p_surname, email = p_email, phone = p_phone
+        WHERE c.id = p_client_id
+        RETURNING c.id INTO v_client_id;
+        IF v_client_id IS NULL THEN
+            RAISE EXCEPTION USING MESSAGE = 'Клиент ' || p_client_id || ' не найден';
+        END IF;
+    ELSIF v_client_id IS NULL THEN
+        INSERT INTO client (name, surname, email, phone)
+        VALUES (p_name, p_surname, p_email, p_phone)
+        RETURNING id INTO v_client_id;
+    END IF;
+
+    -- Списание остатков: строка меняется, только если товара хватает
+    WITH lines AS (
+        SELECT (e ->> 'id')::integer AS item_id, sum((e ->> 'quantity')::integer) AS quantity
+        FROM jsonb_array_elements(p_items) AS e
+        GROUP BY 1
+    ), updated AS (
+        UPDATE item i
+        SET in_stock = i.in_stock - l.quantity
+        FROM lines l
+        WHERE i.id = l.item_id AND i.in_stock >= l.quantity
+        RETURNING l.quantity, i.price
+    )
+    SELECT (SELECT count(*) FROM lines), count(*), sum(u.quantity * u.price)
+    INTO v_lines, v_updated, v_total
+    FROM updated u;
+
+    IF v_lines = 0 THEN
+        RAISE EXCEPTION 'Пустой список товаров';
+    END IF;
+    IF v_updated < v_lines THEN
+        RAISE EXCEPTION 'Недостаточно товара на складе';
+    END IF;
+
+    INSERT INTO orders (client_id, delivery_address, total, status, order_date)
+    VALUES (v_client_id, p_address, v_total, p_status, NOW())
+    RETURNING id INTO v_order_id;
+
+    INSERT INTO check_item (check_id, item_id, quantitity)
+    SELECT v_order_id, (e ->> 'id')::integer, sum((e ->> 'quantity')::integer)
+    FROM jsonb_array_elements(p_items) AS e
+    GROUP BY 2;
+
+    RETURN QUERY
+    SELECT o.id::integer, o.client_id::integer, c.name::text, c.surname::text, o.total::numeric,
+           o.delivery_address::text, o.status::text, i.name::text, ci.quantitity::integer, i.price::numeric
+    FROM orders o
+    JOIN client c ON c.id = o.client_id
+    JOIN check_item ci ON ci.check_id = o.id
+    JOIN item i ON i.id = ci.item_id
+    WHERE o.id = v_order_id;
+END;
+$$;
@@ -0,0 +1,55 @@
+"""
+Разовая настройка базы данных: создаёт серверные объекты, которые нужны
+приложению. Запускается администратором при установке или обновлении
+(нужны права на DDL), а не при каждом старте кассы:
+
+    python setup_database.py --user postgres --password ...
+"""
+import argparse
+import os
+import sys
+
+from models.database import Database
+
+SQL_DIR = os.path.join(os.path.dirname(__file__), 'models', 'sql')
+
+# Скрипты выполняются по порядку, каждый можно запускать повторно
+MIGRATIONS = [
+    'place_order.sql',
+    'item_notify.sql',
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Создание серверных функций и триггеров приложения')
+    parser.add_argument('--dbname', default='LAB1')
+    parser.add_argument('--user', default='postgres')
+    parser.add_argument('--password', default='123')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', default='5432')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    db = Database(minconn=1, maxconn=1)
+    if not db.connect(args.dbname, args.user, args.password, args.host, args.port):
+        sys.exit(1)
+
+    try:
+        # Все скрипты в одной транзакции: либо применяются все, либо ни один
+        with db.transaction() as tx:
+            for name in MIGRATIONS:
+                print(f"Применяется {name}")
+                with open(os.path.join(SQL_DIR, name), encoding='utf-8') as f:
+                    tx.execute_query(f.read())
+        print("База данных настроена")
+    except Exception as e:
+        print(f"Ошибка настройки базы данных: {e}")
+        sys.exit(1)
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
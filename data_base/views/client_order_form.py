@@ -1,28 +1,36 @@
 from PyQt5.QtWidgets import (QWidget, QVBoxLayout, QHBoxLayout, QLabel,
                              QLineEdit, QPushButton, QTableWidget,
                              QTableWidgetItem, QMessageBox, QComboBox)
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, QTimer
 from PyQt5.QtGui import QIntValidator
 from controllers.client_controller import ClientController
 from controllers.product_controller import ProductController
 from controllers.order_controller import OrderController
 
+PRODUCTS_REFRESH_MS = 2000  # Как часто проверять, не сброшен ли кэш товаров (например, по NOTIFY)
+
 
 class ClientOrderForm(QWidget):
-    def __init__(self, db_connection):
+    def __init__(self, db_connection, catalog):
         super().__init__()
         # Инициализация контроллеров
         self.client_controller = ClientController(db_connection)
-        self.product_controller = ProductController(db_connection)
+        self.product_controller = ProductController(db_connection, catalog)
         self.order_controller = OrderController(db_connection)
 
         self.cart = []
         self.cart_items = {}
         self.current_client_id = None
+        self.products_version = None
         self.setup_ui()
         self.load_products()
         self.update_cart_table()
 
+        # Кэш сбрасывается фоновым потоком подписки, а виджеты можно менять только из потока окна
+        self.products_timer = QTimer(self)
+        self.products_timer.timeout.connect(self.refresh_products)
+        self.products_timer.start(PRODUCTS_REFRESH_MS)
+
     def setup_ui(self):
         self.setWindowTitle("Оформление заказа")
         self.setFixedSize(900, 700)
@@ -197,7 +205,13 @@ class ClientOrderForm(QWidget):
         self.email_input.clear()
         self.phone_display.clear()
 
+    def refresh_products(self):
+        """Перерисовка списка товаров, если кэш каталога сброшен после последней загрузки"""
+        if self.product_controller.catalog_version() != self.products_version:
+            self.load_products()
+
     def load_products(self):
+        self.products_version = self.product_controller.catalog_version()
         products = self.product_controller.get_available_products()
 
         if not products:
@@ -237,13 +251,16 @@ class ClientOrderForm(QWidget):
 
             product_id = self.product_controller.get_product_id_by_name(product_name)
             if product_id is None:
-                QMessageBox.warning(self, "Ошибка", "Не удалось определить ID товара")
+                # Товар раскупили с другого рабочего места, а список ещё не обновился
+                QMessageBox.warning(self, "Ошибка", f"Товара «{product_name}» больше нет в наличии")
+                self.load_products()
                 return
 
             if product_id in self.cart_items:
                 self.cart_items[product_id]['quantity'] += quantity
             else:
                 self.cart_items[product_id] = {
+                    'id': product_id,
                     'name': product_name,
                     'price': price,
                     'quantity': quantity
@@ -269,9 +286,8 @@ class ClientOrderForm(QWidget):
 
     def remove_from_cart(self, row):
         if 0 <= row < len(self.cart):
-            product_id = self.product_controller.get_product_id_by_name(self.cart[row]['name'])
-            del self.cart_items[product_id]
-            self.cart.pop(row)
+            item = self.cart.pop(row)
+            del self.cart_items[item['id']]
             self.update_cart_table()
 
     def submit_order(self):
@@ -289,62 +305,37 @@ class ClientOrderForm(QWidget):
             if not phone:
                 raise Exception("Телефон обязателен")
 
-            # Получаем или создаем клиента
-            result = self.client_controller.handle_client_update(
+            # Подготавливаем товары для заказа (ID запомнены при добавлении в корзину)
+            order_items = [{
+                'id': item['id'],
+                'price': item['price'],
+                'quantity': item['quantity']
+            } for item in self.cart]
+
+            # Клиент, заказ и списание остатков - одним запросом к серверу
+            order = self.order_controller.place_order(
+                self.current_client_id,  # Передаем текущий ID, если клиент существует
                 self.name_input.text(),
                 self.surname_input.text(),
                 self.email_input.text(),
                 phone,
-                self.current_client_id  # Передаем текущий ID, если клиент существует
-            )
-            if not isinstance(result, int):
-                raise Exception("Ошибка: некорректный ID клиента")
-
-            client_id = result
-            print(f"Используем client_id: {client_id} ({type(client_id)})")  # Для отладки
-            if not result:
-                raise Exception("Не удалось получить/создать клиента. Возможно телефон занят другим клиентом")
-
-            # Обрабатываем разные форматы возвращаемого значения
-            if isinstance(result, tuple):
-                client_id = result[0][0]
-            elif isinstance(result, int):
-                client_id = result
-            else:
-                raise Exception("Неожиданный формат данных клиента")
-
-            self.current_client_id = client_id  # Сохраняем ID для будущих обновлений
-
-            # Подготавливаем товары для заказа
-            order_items = []
-            for item in self.cart:
-                product_id = self.product_controller.get_product_id_by_name(item['name'])
-                if not product_id:
-                    raise Exception(f"Не найден ID товара: {item['name']}")
-
-                order_items.append({
-                    'id': product_id,
-                    'price': item['price'],
-                    'quantity': item['quantity']
-                })
-
-            # Создаем заказ
-            order_id = self.order_controller.create_new_order(
-                client_id,
                 self.address_input.text(),
                 order_items
             )
 
-            if not order_id:
-                raise Exception("Не удалось создать заказ в базе данных")
+            if not order:
+                raise Exception("Не удалось создать заказ. Возможно, телефон занят другим клиентом "
+                                "или товара не хватает на складе")
+
+            order_id = order['order_id']
+            print(f"Используем client_id: {order['client_id']}")  # Для отладки
 
-            # Обновляем остатки товаров
-            for item in self.cart:
-                product_id = self.product_controller.get_product_id_by_name(item['name'])
-                self.product_controller.update_product_stock(product_id, item['quantity'])
+            # Остатки изменились: перечитываем каталог товаров
+            self.product_controller.invalidate_catalog()
+            self.load_products()
 
             # Показываем чек и очищаем корзину
-            self.show_receipt(order_id)
+            self.show_receipt(order_id, order['order_info'], order['items'])
             self.cart.clear()
             self.cart_items.clear()
             self.update_cart_table()
@@ -359,15 +350,17 @@ class ClientOrderForm(QWidget):
             QMessageBox.critical(self, "Ошибка", f"Не удалось оформить заказ: {str(e)}")
             print(f"Ошибка при оформлении заказа: {str(e)}")  # Для отладки
 
-    def show_receipt(self, order_id):
+    def show_receipt(self, order_id, order_info=None, items=None):
         try:
-            # Получаем информацию о заказе
-            order_info = self.order_controller.get_order_info(order_id)
+            # Получаем информацию о заказе, если её не вернуло оформление заказа
+            if order_info is None:
+                order_info = self.order_controller.get_order_info(order_id)
             if not order_info:
                 raise Exception("Заказ не найден")
 
             # Получаем товары в заказе
-            items = self.order_controller.get_order_items(order_id)
+            if items is None:
+                items = self.order_controller.get_order_items(order_id)
             if not items:
                 raise Exception("Товары в заказе не найдены")
 
@@ -0,0 +1,84 @@
+import numpy as np
+import pandas as pd
+
+from coverage import hour_of_day_coverage, window_coverage
+from simulation import TARGET_THRESHOLDS, campaign_win_table
+
+# Upper bound on audience rows evaluated at once
+DEFAULT_BATCH_ROWS = 500_000
+
+
+def truncated_binomial(trials, p):
+    """P(0), P(1) and P(2) successes of Binomial(trials, p), elementwise"""
+    q = 1 - p
+    b0 = q ** trials
+    b1 = np.where(trials >= 1, trials * p * q ** np.maximum(trials - 1, 0), 0)
+    b2 = np.where(trials >= 2, trials * (trials - 1) / 2 * p ** 2 * q ** np.maximum(trials - 2, 0), 0)
+    return b0, b1, b2
+
+
+def at_least_probabilities(trials, p):
+    """
+    P(X >= 1), P(X >= 2), P(X >= 3) for X = sum over hours of day of
+    Binomial(trials[:, h], p[:, h]): a Poisson-binomial count, convolved one
+    hour of day at a time and truncated at three successes. Shape (rows, 3).
+    """
+    state = np.zeros((len(p), 3))  # P(X = 0), P(X = 1), P(X = 2) so far
+    state[:, 0] = 1
+    for hod in range(p.shape[1]):
+        b0, b1, b2 = truncated_binomial(trials[:, hod], p[:, hod])
+        state = np.stack([state[:, 0] * b0,
+                          state[:, 0] * b1 + state[:, 1] * b0,
+                          state[:, 0] * b2 + state[:, 1] * b1 + state[:, 2] * b0], axis=1)
+    return np.clip(1 - np.cumsum(state, axis=1), 0, 1)
+
+
+def session_view_probabilities(tables, columns, win, user_ids):
+    """
+    Chance that a user opens a session at each hour of day and sees the ad in
+    it, shape (users, 24). A session spans 1 / session_share active hours on
+    average and the ad is shown at most once per session.
+    """
+    hour_activity, show_probability, session_share = tables.audience_rates(user_ids, columns, win)
+    session_share = np.maximum(session_share, 1e-6)[:, None]
+    session_view = 1 - (1 - show_probability) ** (1 / session_share)
+    return np.clip(hour_activity * session_share * session_view, 0, 1)
+
+
+def estimate_reach(tasks, tables, auction_index, batch_rows=DEFAULT_BATCH_ROWS):
+    """
+    Closed-form counterpart of simulate_campaigns: the expected share of each
+    audience with at least one/two/three views. Every (user, hour of day) of a
+    campaign window is a binomial number of session opportunities, so no
+    sampling and no training is needed. Returns a DataFrame like simulate_campaigns.
+    """
+    coverage = window_coverage(tasks['hour_start'].to_numpy(), tasks['hour_end'].to_numpy())
+    hour_counts = hour_of_day_coverage(coverage)
+    reach = np.zeros((len(tasks), len(TARGET_THRESHOLDS)))
+
+    def flush(batch_tasks, batch_p, batch_trials):
+        sizes = np.array([len(p) for p in batch_p])
+        probabilities = at_least_probabilities(np.concatenate(batch_trials), np.concatenate(batch_p))
+        non_empty = sizes > 0
+        starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])[non_empty]
+        if len(starts):
+            reach[np.array(batch_tasks)[non_empty]] = \
+                np.add.reduceat(probabilities, starts, axis=0) / sizes[non_empty, None]
+
+    batch_tasks, batch_p, batch_trials, n_rows = [], [], [], 0
+    for pos, task in enumerate(tasks[['cpm', 'publishers', 'user_ids']].itertuples(index=False)):
+        columns, win = campaign_win_table(tables, auction_index, task.cpm, task.publishers.split(','))
+        p = session_view_probabilities(tables, columns, win, task.user_ids)
+        batch_tasks.append(pos)
+        batch_p.append(p)
+        batch_trials.append(np.broadcast_to(hour_counts[pos], p.shape))
+        n_rows += len(p)
+        if n_rows >= batch_rows:
+            flush(batch_tasks, batch_p, batch_trials)
+            batch_tasks, batch_p, batch_trials, n_rows = [], [], [], 0
+    if batch_tasks:
+        flush(batch_tasks, batch_p, batch_trials)
+
+    result = pd.DataFrame(reach, columns=list(TARGET_THRESHOLDS))
+    result.insert(0, 'idx', tasks.index)
+    return result
@@ -0,0 +1,187 @@
+import numpy as np
+import pandas as pd
+
+HOURS_PER_DAY = 24
+DEFAULT_WIN_PROBABILITY = 0.5  # Used when a publisher has no history at all
+
+
+def win_probability_from_counts(higher_count, equal_count, total_count):
+    """
+    Vectorized auction rule used by the ad features:
+    any higher bid -> 0, tie with another bid -> 0.5, otherwise -> 1
+    """
+    higher_count = np.asarray(higher_count)
+    equal_count = np.asarray(equal_count)
+    total_count = np.asarray(total_count)
+
+    win_prob = np.where(equal_count > 1, 0.5, 1.0)
+    win_prob = np.where(higher_count > 0, 0.0, win_prob)
+    win_prob = np.where(total_count > 0, win_prob, DEFAULT_WIN_PROBABILITY)
+    return win_prob
+
+
+def impression_win_probability_from_counts(higher_count, equal_count, total_count):
+    """
+    README auction rule applied to each historical impression, whose cpm was the
+    winning bid of its auction: a higher cpm wins it, an equal cpm wins half the time
+    """
+    higher_count = np.asarray(higher_count, dtype=np.float64)
+    equal_count = np.asarray(equal_count, dtype=np.float64)
+    total_count = np.asarray(total_count, dtype=np.float64)
+
+    lower_count = total_count - higher_count - equal_count
+    win_prob = (lower_count + 0.5 * equal_count) / np.maximum(total_count, 1)
+    return np.where(total_count > 0, win_prob, DEFAULT_WIN_PROBABILITY)
+
+
+class CpmWinIndex:
+    """
+    Sorted CPM index answering "how many bids are > cpm / == cpm" per group.
+
+    Bids are stored as unique (group, cpm) pairs with cumulative counts, so a
+    whole batch of queries is answered with a couple of `searchsorted` calls
+    instead of scanning the history once per query.
+    """
+
+    def __init__(self, group_codes, cpm, n_groups, counts=None):
+        group_codes = np.asarray(group_codes, dtype=np.int64)
+        cpm = np.asarray(cpm)
+        if counts is None:
+            counts = np.ones(len(cpm), dtype=np.int64)
+        counts = np.asarray(counts, dtype=np.int64)
+
+        self.n_groups = int(n_groups)
+
+        # Rank-encode CPM values so that (group, cpm) becomes one exact int64 key
+        self.cpm_values, cpm_rank = np.unique(cpm, return_inverse=True)
+        self._stride = len(self.cpm_values) + 1
+        keys = group_codes * self._stride + cpm_rank.reshape(-1)
+
+        self.keys, inverse = np.unique(keys, return_inverse=True)
+        key_counts = np.bincount(inverse.reshape(-1), weights=counts, minlength=len(self.keys))
+        self.cum_counts = np.concatenate([[0], np.cumsum(key_counts, dtype=np.int64)])
+
+        group_bounds = np.arange(self.n_groups + 1, dtype=np.int64) * self._stride
+        self.group_offsets = np.searchsorted(self.keys, group_bounds, side='left')
+
+    def counts(self, group_codes, cpm):
+        """Return (higher_count, equal_count, total_count) arrays for a batch of queries"""
+        group_codes = np.asarray(group_codes, dtype=np.int64)
+        # Compare in the dtype the bids are stored in, so float32 history matches exactly
+        cpm = np.asarray(cpm, dtype=self.cpm_values.dtype)
+
+        known = (group_codes >= 0) & (group_codes < self.n_groups)
+        safe_groups = np.where(known, group_codes, 0)
+
+        base = safe_groups * self._stride
+        first_ge = np.searchsorted(self.keys, base + np.searchsorted(self.cpm_values, cpm, side='left'))
+        first_gt = np.searchsorted(self.keys, base + np.searchsorted(self.cpm_values, cpm, side='right'))
+        group_start = self.group_offsets[safe_groups]
+        group_end = self.group_offsets[safe_groups + 1]
+
+        higher_count = self.cum_counts[group_end] - self.cum_counts[first_gt]
+        equal_count = self.cum_counts[first_gt] - self.cum_counts[first_ge]
+        total_count = self.cum_counts[group_end] - self.cum_counts[group_start]
+
+        higher_count = np.where(known, higher_count, 0)
+        equal_count = np.where(known, equal_count, 0)
+        total_count = np.where(known, total_count, 0)
+        return higher_count, equal_count, total_count
+
+    def win_probability(self, group_codes, cpm):
+        return win_probability_from_counts(*self.counts(group_codes, cpm))
+
+    def impression_win_probability(self, group_codes, cpm):
+        return impression_win_probability_from_counts(*self.counts(group_codes, cpm))
+
+    def quantile_bid(self, q):
+        """Linear-interpolated quantile over all groups (q=0.5 gives the usual median)"""
+        value_rank = self.keys % self._stride
+        key_counts = np.diff(self.cum_counts)
+        value_counts = np.bincount(value_rank, weights=key_counts, minlength=len(self.cpm_values))
+        cum_values = np.cumsum(value_counts)
+        if cum_values[-1] == 0:
+            return np.nan
+
+        position = q * (cum_values[-1] - 1)
+        lower = np.searchsorted(cum_values, np.floor(position), side='right')
+        upper = np.searchsorted(cum_values, np.ceil(position), side='right')
+        fraction = position - np.floor(position)
+        lower_value = float(self.cpm_values[lower])
+        upper_value = float(self.cpm_values[upper])
+        return lower_value + (upper_value - lower_value) * fraction
+
+
+class AuctionIndex:
+    """
+    Per-publisher and per publisher x hour-of-day CPM indexes built once from history
+    """
+
+    def __init__(self, publishers, cpm, hour_of_day=None, counts=None):
+        publishers = pd.Series(publishers).astype(str)
+        codes, labels = pd.factorize(publishers, sort=True)
+        self.publishers = list(labels)
+        self._publisher_codes = {pub: code for code, pub in enumerate(self.publishers)}
+
+        n_publishers = len(self.publishers)
+        self.by_publisher = CpmWinIndex(codes, cpm, n_publishers, counts)
+
+        self.by_publisher_hour = None
+        if hour_of_day is not None:
+            hour_codes = codes * HOURS_PER_DAY + np.asarray(hour_of_day, dtype=np.int64)
+            self.by_publisher_hour = CpmWinIndex(hour_codes, cpm, n_publishers * HOURS_PER_DAY, counts)
+
+    @classmethod
+    def from_history(cls, history):
+        hour_of_day = history['hour_of_day'] if 'hour_of_day' in history.columns else None
+        return cls(history['publisher'], history['cpm'].values, hour_of_day)
+
+    @classmethod
+    def from_counts(cls, cpm_counts):
+        """Build from a (publisher, hour_of_day, cpm, count) value-count table"""
+        return cls(cpm_counts['publisher'], cpm_counts['cpm'].values,
+                   cpm_counts['hour_of_day'].values, cpm_counts['count'].values)
+
+    def median_cpm(self):
+        """Median of all indexed bids, averaging the two middle bids like pandas does"""
+        return self.by_publisher.quantile_bid(0.5)
+
+    def publisher_codes(self, publishers):
+        """Map publisher labels to index codes, -1 for publishers never seen in history"""
+        return np.array([self._publisher_codes.get(str(pub), -1) for pub in publishers], dtype=np.int64)
+
+    def _lookup(self, publishers, hour_of_day):
+        codes = self.publisher_codes(publishers)
+        if hour_of_day is None:
+            return self.by_publisher, codes
+
+        if self.by_publisher_hour is None:
+            raise ValueError("AuctionIndex was built without hour_of_day")
+        hour_of_day = np.asarray(hour_of_day, dtype=np.int64)
+        return self.by_publisher_hour, np.where(codes >= 0, codes * HOURS_PER_DAY + hour_of_day, -1)
+
+    def win_probability(self, publishers, cpm, hour_of_day=None):
+        """Win probability for each (publisher, cpm[, hour_of_day]) query"""
+        index, codes = self._lookup(publishers, hour_of_day)
+        return index.win_probability(codes, cpm)
+
+    def impression_win_probability(self, publishers, cpm, hour_of_day=None):
+        """Share of historical impressions a bid of `cpm` would win, per query"""
+        index, codes = self._lookup(publishers, hour_of_day)
+        return index.impression_win_probability(codes, cpm)
+
+    def task_win_probability(self, cpm, publishers):
+        """
+        Average per-publisher win probability for a batch of tasks.
+        `publishers` is a sequence of publisher lists, one per task; a publisher
+        listed twice in a task is counted once.
+        """
+        cpm = np.asarray(cpm)
+        publishers = [list(dict.fromkeys(pubs)) for pubs in publishers]
+        lengths = np.array([len(pubs) for pubs in publishers], dtype=np.int64)
+        task_pos = np.repeat(np.arange(len(lengths)), lengths)
+        flat_publishers = [pub for pubs in publishers for pub in pubs]
+
+        probs = self.win_probability(flat_publishers, cpm[task_pos])
+        sums = np.bincount(task_pos, weights=probs, minlength=len(lengths))
+        return sums / np.maximum(lengths, 1)
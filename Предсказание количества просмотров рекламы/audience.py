@@ -0,0 +1,128 @@
+import numpy as np
+import pandas as pd
+
+PUBLISHER_MASK_BITS = 63  # Bits per publisher_mask_<n> word, keeps the int64 words non-negative
+MASK_COLUMN_PREFIXES = ('publisher_mask_', 'hour_mask', 'weekday_mask')
+DEMOGRAPHIC_COLUMNS = ['sex', 'age_group', 'city_id']
+EXCLUDED_STAT_COLUMNS = ['user_id', 'age']
+
+# Upper bound on audience rows gathered at once by the batched path
+DEFAULT_BATCH_ROWS = 200_000
+
+
+def publisher_mask_words(publishers, all_publishers):
+    """Bitset of `publishers` laid out like the publisher_mask_<n> user feature columns"""
+    positions = {str(pub): pos for pos, pub in enumerate(all_publishers)}
+    words = np.zeros(max(1, -(-len(all_publishers) // PUBLISHER_MASK_BITS)), dtype=np.int64)
+    for pub in publishers:
+        pos = positions.get(str(pub))
+        if pos is not None:
+            words[pos // PUBLISHER_MASK_BITS] |= np.int64(1) << np.int64(pos % PUBLISHER_MASK_BITS)
+    return words
+
+
+class UserFeatureMatrix:
+    """
+    User features as dense NumPy arrays with a user_id -> row index, so audience
+    statistics are computed by fancy-indexing instead of scanning the user table.
+    """
+
+    def __init__(self, user_features):
+        self.user_index = pd.Index(user_features['user_id'].to_numpy())
+
+        numeric_cols = user_features.select_dtypes(include=[np.number]).columns
+        self.stat_columns = [col for col in numeric_cols
+                             if col not in EXCLUDED_STAT_COLUMNS and not col.startswith(MASK_COLUMN_PREFIXES)]
+        self.values = user_features[self.stat_columns].to_numpy(dtype=np.float64)
+
+        # Demographics as integer codes, so proportions are one bincount per batch
+        self.demographics = []
+        for demo_col in DEMOGRAPHIC_COLUMNS:
+            if demo_col in user_features.columns:
+                codes, labels = pd.factorize(user_features[demo_col], sort=True)
+                self.demographics.append((demo_col, codes, list(labels)))
+
+        self.publishers = user_features.attrs.get('publishers', [])
+        mask_cols = [col for col in user_features.columns if col.startswith('publisher_mask_')]
+        self.publisher_masks = user_features[mask_cols].to_numpy(dtype=np.int64)
+
+        self.output_columns = self._output_columns()
+
+    def _output_columns(self):
+        columns = [f'audience_{demo_col}_{label}_prop'
+                   for demo_col, _, labels in self.demographics for label in labels]
+        for col in self.stat_columns:
+            columns += [f'audience_{col}_mean', f'audience_{col}_median', f'audience_{col}_std']
+        return columns + ['audience_publisher_match_prop']
+
+    def rows(self, user_ids):
+        """Matrix rows of the audience members present in the user table"""
+        rows = self.user_index.get_indexer(np.asarray(user_ids))
+        return rows[rows >= 0]
+
+    def audience_stats(self, user_ids, publishers):
+        """Statistics of a single audience, as a one-row DataFrame"""
+        return self.batch_audience_stats([user_ids], [publishers])
+
+    def batch_audience_stats(self, audiences, publishers, batch_rows=DEFAULT_BATCH_ROWS):
+        """
+        Statistics for many audiences at once. Audiences are gathered into one
+        row block per batch and reduced per task with reduceat/bincount.
+        `publishers` holds the publisher list of each task.
+        """
+        task_rows = [self.rows(user_ids) for user_ids in audiences]
+        stats = np.full((len(task_rows), len(self.output_columns)), np.nan)
+
+        start = 0
+        while start < len(task_rows):
+            stop, n_rows = start, 0
+            while stop < len(task_rows) and (stop == start or n_rows + len(task_rows[stop]) <= batch_rows):
+                n_rows += len(task_rows[stop])
+                stop += 1
+            stats[start:stop] = self._reduce_batch(task_rows[start:stop], publishers[start:stop])
+            start = stop
+
+        return pd.DataFrame(stats, columns=self.output_columns)
+
+    def _reduce_batch(self, task_rows, task_publishers):
+        sizes = np.array([len(rows) for rows in task_rows], dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(sizes)])
+        task_of_row = np.repeat(np.arange(len(task_rows)), sizes)
+        rows = np.concatenate(task_rows) if len(task_rows) else np.zeros(0, dtype=np.int64)
+        non_empty = sizes > 0
+        starts = offsets[:-1][non_empty]
+
+        result = []
+        with np.errstate(invalid='ignore', divide='ignore'):
+            # Demographic proportions among the audience members whose value is known
+            # (missing values are left out of the denominator, like value_counts(normalize=True))
+            for _, codes, labels in self.demographics:
+                row_codes = codes[rows]
+                valid = row_codes >= 0
+                counts = np.bincount(task_of_row[valid] * len(labels) + row_codes[valid],
+                                     minlength=len(task_rows) * len(labels)).reshape(len(task_rows), len(labels))
+                result.append(counts / counts.sum(axis=1, keepdims=True))
+
+            # Numeric mean/median/std (sample std, like pandas)
+            block = self.values[rows]
+            n_cols = block.shape[1]
+            mean = np.full((len(task_rows), n_cols), np.nan)
+            median = np.full((len(task_rows), n_cols), np.nan)
+            std = np.full((len(task_rows), n_cols), np.nan)
+            if len(starts):
+                mean[non_empty] = np.add.reduceat(block, starts, axis=0) / sizes[non_empty, None]
+                squared_dev = (block - mean[task_of_row]) ** 2
+                std[non_empty] = np.sqrt(np.add.reduceat(squared_dev, starts, axis=0)
+                                         / (sizes[non_empty, None] - 1))
+            for task in np.flatnonzero(non_empty):
+                median[task] = np.median(block[offsets[task]:offsets[task + 1]], axis=0)
+            result.append(np.stack([mean, median, std], axis=2).reshape(len(task_rows), 3 * n_cols))
+
+            # Share of the audience seen on any of the campaign publishers
+            ad_masks = np.array([publisher_mask_words(pubs, self.publishers) for pubs in task_publishers],
+                                dtype=np.int64).reshape(len(task_rows), -1)
+            match = (self.publisher_masks[rows] & ad_masks[task_of_row][:, :self.publisher_masks.shape[1]]) \
+                .any(axis=1)
+            result.append((np.bincount(task_of_row, weights=match, minlength=len(task_rows)) / sizes)[:, None])
+
+        return np.hstack(result)
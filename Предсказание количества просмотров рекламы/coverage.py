@@ -0,0 +1,35 @@
+import numpy as np
+
+from auction import HOURS_PER_DAY
+
+DAYS_PER_WEEK = 7
+HOURS_PER_WEEK = DAYS_PER_WEEK * HOURS_PER_DAY
+# Hour 0 is a Thursday, so shift by three days to make slot 0 Monday 00:00
+WEEK_SLOT_SHIFT = 3 * HOURS_PER_DAY
+
+
+def week_slot(hour):
+    """weekday * 24 + hour_of_day of absolute hours, weekday 0 = Monday"""
+    return (np.asarray(hour, dtype=np.int64) + WEEK_SLOT_SHIFT) % HOURS_PER_WEEK
+
+
+def window_coverage(hour_start, hour_end):
+    """
+    How many hours of each weekday x hour-of-day slot the inclusive windows
+    [hour_start, hour_end] contain, shape (tasks, 168). Handles windows that
+    wrap midnight or span several days/weeks.
+    """
+    start_slot = week_slot(hour_start)
+    length = np.maximum(np.asarray(hour_end, dtype=np.int64) - np.asarray(hour_start, dtype=np.int64) + 1, 0)
+    offset = (np.arange(HOURS_PER_WEEK) - start_slot[:, None]) % HOURS_PER_WEEK
+    return (length[:, None] // HOURS_PER_WEEK + (offset < (length % HOURS_PER_WEEK)[:, None])).astype(np.int32)
+
+
+def hour_of_day_coverage(coverage):
+    """Hours of each hour of day in the windows, shape (tasks, 24)"""
+    return coverage.reshape(-1, DAYS_PER_WEEK, HOURS_PER_DAY).sum(axis=1)
+
+
+def weekday_coverage(coverage):
+    """Hours of each weekday in the windows, shape (tasks, 7)"""
+    return coverage.reshape(-1, DAYS_PER_WEEK, HOURS_PER_DAY).sum(axis=2)
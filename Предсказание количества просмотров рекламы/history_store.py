@@ -0,0 +1,101 @@
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+CACHE_VERSION = 1
+DEFAULT_CACHE_DIR = os.path.join('artifacts', 'history_cache')
+
+# Compact on-disk/in-memory dtypes for history.tsv columns
+HISTORY_DTYPES = {
+    'hour': np.int32,
+    'cpm': np.float32,
+    'publisher': 'category',
+    'user_id': np.int32,
+}
+NUMERIC_COLUMNS = ['hour', 'cpm', 'user_id']
+
+
+def _source_signature(path):
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def _read_meta(cache_dir):
+    meta_path = os.path.join(cache_dir, 'meta.json')
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def read_history_tsv(path, **read_csv_kwargs):
+    """Parse history.tsv straight into compact dtypes (no Python str user ids)"""
+    return pd.read_csv(path, sep='\t', usecols=list(HISTORY_DTYPES), dtype=HISTORY_DTYPES,
+                       **read_csv_kwargs)
+
+
+def write_history_cache(history, cache_dir, source_path):
+    """Store history as one .npy file per column plus a small JSON meta file"""
+    tmp_dir = cache_dir + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    for col in NUMERIC_COLUMNS:
+        np.save(os.path.join(tmp_dir, f'{col}.npy'), history[col].to_numpy(dtype=HISTORY_DTYPES[col]))
+
+    publisher = history['publisher'].astype('category')
+    codes_dtype = np.int8 if len(publisher.cat.categories) < 127 else np.int16
+    np.save(os.path.join(tmp_dir, 'publisher.npy'), publisher.cat.codes.to_numpy(dtype=codes_dtype))
+
+    meta = {
+        'version': CACHE_VERSION,
+        'rows': len(history),
+        'publishers': [str(pub) for pub in publisher.cat.categories],
+        'source': _source_signature(source_path),
+    }
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+
+    # Swap the fully written cache into place so a crash never leaves a half-written one
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    os.replace(tmp_dir, cache_dir)
+
+
+def read_history_cache(cache_dir, mmap_mode='r'):
+    """Memory-map the cached history columns into a DataFrame without copying"""
+    meta = _read_meta(cache_dir)
+    columns = {}
+    for col in HISTORY_DTYPES:
+        values = np.load(os.path.join(cache_dir, f'{col}.npy'), mmap_mode=mmap_mode)
+        if col == 'publisher':
+            values = pd.Categorical.from_codes(values, categories=meta['publishers'])
+        columns[col] = values
+
+    return pd.DataFrame(columns, copy=False)
+
+
+def is_cache_valid(cache_dir, source_path):
+    meta = _read_meta(cache_dir)
+    if meta is None or meta.get('version') != CACHE_VERSION:
+        return False
+    signature = _source_signature(source_path)
+    # A cache without its source TSV next to it is still usable as-is
+    return signature is None or meta.get('source') == signature
+
+
+def load_history(path='history.tsv', cache_dir=DEFAULT_CACHE_DIR, refresh=False):
+    """
+    Load history with compact dtypes. The first read parses the TSV and writes
+    a columnar .npy cache; later reads memory-map that cache instead.
+    """
+    if not refresh and is_cache_valid(cache_dir, path):
+        return read_history_cache(cache_dir)
+
+    history = read_history_tsv(path)
+    write_history_cache(history, cache_dir, path)
+    return read_history_cache(cache_dir)
@@ -1,434 +1,298 @@
 import pandas as pd
 import numpy as np
-from catboost import CatBoostRegressor, Pool
+from scipy import sparse
 from sklearn.model_selection import train_test_split, KFold
-from sklearn.metrics import mean_absolute_error
 import matplotlib.pyplot as plt
 import seaborn as sns
 import warnings
-from tqdm import tqdm
 import pickle
 import os
+import argparse
+from functools import partial
+
+from analytical import estimate_reach
+from audience import PUBLISHER_MASK_BITS, UserFeatureMatrix
+from auction import AuctionIndex
+from coverage import hour_of_day_coverage, weekday_coverage, window_coverage
+from history_store import load_history
+from metrics import EPSILON, log_accuracy_ratios, overall_score, percentage_error, smoothed_log_accuracy_ratio
+from profiling import StageProfiler
+from sessions import segment_sessions, user_session_numbers
+from simulation import SimulationTables, simulate_campaigns
+from sketches import build_cpm_sketch
+from stage_cache import StageCache
+from training import MULTI_TARGET, chain_ratios, conditional_ratios, fit_catboost_jobs, predict_targets
+from streaming import DEFAULT_PARTITION_MB, stream_history_features
 
 warnings.filterwarnings('ignore')
 
 # Constants
 TARGET_COLS = ['at_least_one', 'at_least_two', 'at_least_three']
-EPS = 0.005  # For the evaluation metric
+EPS = EPSILON  # For the evaluation metric
 
 
-def calculate_metric(y_true, y_pred):
-    """
-    Calculate the Smoothed Mean Log Accuracy Ratio as described in the task
-    """
-    log_ratios = np.abs(np.log((y_pred + EPS) / (y_true + EPS)))
-    metric = 100 * (np.exp(np.mean(log_ratios)) - 1)
-    return metric
-
-
-def load_data():
+def load_data(with_history=True):
     """Load data with proper dtypes"""
-    users = pd.read_csv('users.tsv', sep='\t', dtype={'user_id': str})
-    history = pd.read_csv('history.tsv', sep='\t', dtype={'user_id': str})
+    users = pd.read_csv('users.tsv', sep='\t', dtype={'user_id': np.int32})
+    history = load_history('history.tsv') if with_history else None
     validate = pd.read_csv('validate.tsv', sep='\t')
     answers = pd.read_csv('validate_answers.tsv', sep='\t')
 
-    # Convert user_ids to list
-    validate['user_ids'] = validate['user_ids'].apply(lambda x: x.split(',') if isinstance(x, str) else [])
+    validate['user_ids'] = parse_user_ids(validate['user_ids'])
 
     return users, history, validate, answers
 
 
-def preprocess_history(history):
-    """Preprocess history data to extract useful time features and session info"""
-    # Convert hour to datetime for easier manipulation
-    history['datetime'] = pd.to_datetime(history['hour'], unit='h')
-    history['day'] = history['datetime'].dt.day
-    history['hour_of_day'] = history['datetime'].dt.hour
-    history['weekday'] = history['datetime'].dt.weekday
-
-    # Sort by user_id and datetime
-    history = history.sort_values(['user_id', 'datetime'])
+def parse_user_ids(user_ids):
+    """Convert comma-separated user_ids to integer arrays matching the history user ids"""
+    return user_ids.apply(
+        lambda x: np.array(x.split(','), dtype=np.int32) if isinstance(x, str) else np.array([], dtype=np.int32))
 
-    # Identify sessions (gap of 6+ hours means new session)
-    history['prev_datetime'] = history.groupby('user_id')['datetime'].shift(1)
-    history['time_diff'] = (history['datetime'] - history['prev_datetime']).dt.total_seconds() / 3600
-    history['new_session'] = (history['time_diff'] > 6) | (history['time_diff'].isna())
-    history['session_id'] = history.groupby('user_id')['new_session'].cumsum()
 
-    # Create a unique session identifier combining user_id and session_id
-    history['user_session'] = history['user_id'] + '_' + history['session_id'].astype(str)
+def preprocess_history(history):
+    """Preprocess history data to extract useful time features and session info"""
+    # Derive calendar features from the integer hour (hour 0 is 1970-01-01 00:00, a Thursday)
+    hour = history['hour'].to_numpy()
+    days, day_inverse = np.unique(hour // 24, return_inverse=True)
+    history['day'] = pd.to_datetime(days, unit='D').day.to_numpy(dtype=np.int8)[day_inverse]
+    history['hour_of_day'] = (hour % 24).astype(np.int8)
+    history['weekday'] = ((hour // 24 + 3) % 7).astype(np.int8)
+
+    # Sort by user_id and hour and split into sessions (gap of 6+ hours means new session)
+    order, session = segment_sessions(history['user_id'].to_numpy(), hour)
+    history = history.take(order)
+    history['session'] = session  # Global session id, unique across users
+    history['session_id'] = user_session_numbers(history['user_id'].to_numpy(), session).astype(np.int32)
 
     return history
 
 
-def analyze_auction_dynamics(history):
+def analyze_auction_dynamics(history, n_jobs=1):
     """Analyze the auction dynamics to understand CPM patterns"""
-    # Get distribution of CPM by publisher and hour
-    cpm_publisher_hour = history.groupby(['publisher', 'hour_of_day'])['cpm'].agg(
-        ['mean', 'median', 'std', 'count']).reset_index()
-
-    # For each publisher and hour, calculate the win probability for a sample of CPM values
-    cpm_win_probs = []
-
-    # Only process the top publishers by frequency to reduce computation
-    top_publishers = history['publisher'].value_counts().nlargest(10).index.tolist()
-
-    for pub in top_publishers:
-        pub_data = history[history['publisher'] == pub]
-        for hour in range(24):
-            hour_data = pub_data[pub_data['hour_of_day'] == hour]
-            if len(hour_data) > 100:  # Only if we have enough data
-                # Instead of all unique CPMs, take a sample of representative values
-                # Use percentiles to get a good distribution
-                cpm_values = np.percentile(hour_data['cpm'].values,
-                                           [0, 10, 25, 50, 75, 90, 95, 99, 100])
-                cpm_values = np.unique(cpm_values)  # Remove duplicates
-
-                for cpm in cpm_values:
-                    # Calculate win probability
-                    higher_count = sum(hour_data['cpm'] > cpm)
-                    equal_count = sum(hour_data['cpm'] == cpm)
-                    total_count = len(hour_data)
-
-                    win_prob = 0
-                    if higher_count == 0:
-                        if equal_count == 0:  # Edge case - no exact matches
-                            win_prob = 1.0  # This is a theoretical highest bid
-                        elif equal_count == 1:  # Only one bid at this level
-                            win_prob = 1.0  # 100% win if highest and unique
-                        else:
-                            # Win probability is 1/n where n is number of equal bids
-                            win_prob = 1.0 / equal_count
-
-                    cpm_win_probs.append({
-                        'publisher': pub,
-                        'hour_of_day': hour,
-                        'cpm': cpm,
-                        'win_probability': win_prob
-                    })
-
-    cpm_win_probs_df = pd.DataFrame(cpm_win_probs)
+    # One pass over history sketches the CPM distribution of every publisher x hour
+    sketch = build_cpm_sketch(history, n_jobs)
+
+    # Distribution of CPM by publisher and hour
+    cpm_publisher_hour = sketch.stats()
+
+    # Win probability at representative CPM percentiles of each publisher x hour with enough data
+    cpm_win_probs_df = sketch.win_probability_table(min_count=100)
     return cpm_publisher_hour, cpm_win_probs_df
 
+
 def create_user_features(users, history):
     """Create comprehensive user-level features"""
-    # Basic demographic features
-    users['age_group'] = pd.cut(users['age'],
-                                bins=[-1, 0, 18, 25, 35, 45, 100],
-                                labels=['unknown', '<18', '18-25', '26-35', '36-45', '45+'])
+    user_index = pd.Index(users['user_id'])
+    return assemble_user_features(users, *aggregate_user_activity(history, user_index))
+
+
+CPM_RANGE_BINS = [0, 10, 50, 100, 500, 1000, np.inf]
+CPM_RANGE_LABELS = ['0-10', '10-50', '50-100', '100-500', '500-1000', '1000+']
+
+
+def user_histograms(history, user_index):
+    """
+    Publisher, hour_of_day, weekday and cpm_range impression counts as one CSR
+    matrix whose rows follow `user_index` (a dense index over all users).
+    The column set is fixed, so matrices from different history slices add up.
+    """
+    rows = user_index.get_indexer(history['user_id'])
+    known = rows >= 0
+
+    publisher = history['publisher'].astype('category')
+    cpm_range = pd.cut(history['cpm'], bins=CPM_RANGE_BINS, labels=CPM_RANGE_LABELS)
+    histograms = [
+        ('publisher', list(publisher.cat.categories), publisher.cat.codes.to_numpy()),
+        ('hour', list(range(24)), history['hour_of_day'].to_numpy()),
+        ('weekday', list(range(7)), history['weekday'].to_numpy()),
+        ('cpm_range', CPM_RANGE_LABELS, cpm_range.cat.codes.to_numpy()),
+    ]
+
+    columns = []
+    row_parts, col_parts = [], []
+    for prefix, values, codes in histograms:
+        valid = known & (codes >= 0)
+        row_parts.append(rows[valid])
+        col_parts.append(codes[valid].astype(np.int64) + len(columns))
+        columns += [f'{prefix}_{value}_count' for value in values]
+
+    row_codes = np.concatenate(row_parts)
+    counts = sparse.csr_matrix((np.ones(len(row_codes), dtype=np.int32), (row_codes, np.concatenate(col_parts))),
+                               shape=(len(user_index), len(columns)))
+    return counts, columns
+
+
+def histogram_bitmask(histograms, histogram_columns, prefix):
+    """
+    Per-user bitmask of the `prefix` histogram columns with any impressions,
+    e.g. a 24-bit mask of the hours of day a user was seen. Returns a list of
+    int64 words of PUBLISHER_MASK_BITS bits each (one word for hours/weekdays).
+    """
+    block_cols = [pos for pos, col in enumerate(histogram_columns) if col.startswith(f'{prefix}_')]
+    words = []
+    for first in range(0, len(block_cols), PUBLISHER_MASK_BITS):
+        seen = (histograms[:, block_cols[first:first + PUBLISHER_MASK_BITS]] > 0).astype(np.int64)
+        bits = np.left_shift(np.int64(1), np.arange(seen.shape[1], dtype=np.int64))
+        words.append(np.asarray(seen @ bits).reshape(-1))
+    return words
+
 
+def aggregate_user_activity(history, user_index):
+    """
+    Per-user activity aggregates. Every user's impressions must be inside
+    `history`, so slices partitioned by user_id can be aggregated independently.
+    Returns (user_activity, histograms, histogram_columns).
+    """
     # Activity patterns by user
     user_activity = history.groupby('user_id').agg({
         'hour': 'count',
         'cpm': ['mean', 'median', 'std', 'min', 'max'],
-        'publisher': lambda x: ','.join(x.astype(str).unique()),  # Convert to string first
         'session_id': 'nunique',
-        'hour_of_day': lambda x: ','.join(x.astype(str).unique()),  # Convert to string first
-        'weekday': lambda x: ','.join(x.astype(str).unique())  # Convert to string first
     }).reset_index()
 
     # Flattening column names
     user_activity.columns = ['_'.join(col).strip('_') if isinstance(col, tuple) else col for col in
                              user_activity.columns]
 
-    # Publisher preferences
-    publisher_counts = history.groupby(['user_id', 'publisher']).size().unstack(fill_value=0)
-    publisher_counts.columns = [f'publisher_{col}_count' for col in publisher_counts.columns]
-    publisher_counts = publisher_counts.reset_index()
+    # Publisher, time of day, weekday and CPM range preferences
+    histograms, histogram_columns = user_histograms(history, user_index)
 
-    # Time of day preferences
-    hour_counts = history.groupby(['user_id', 'hour_of_day']).size().unstack(fill_value=0)
-    hour_counts.columns = [f'hour_{col}_count' for col in hour_counts.columns]
-    hour_counts = hour_counts.reset_index()
+    return user_activity, histograms, histogram_columns
 
-    # Weekday preferences
-    weekday_counts = history.groupby(['user_id', 'weekday']).size().unstack(fill_value=0)
-    weekday_counts.columns = [f'weekday_{col}_count' for col in weekday_counts.columns]
-    weekday_counts = weekday_counts.reset_index()
 
-    # CPM sensitivity - how often user sees ads with different CPM ranges
-    history['cpm_range'] = pd.cut(history['cpm'],
-                                  bins=[0, 10, 50, 100, 500, 1000, np.inf],
-                                  labels=['0-10', '10-50', '50-100', '100-500', '500-1000', '1000+'])
-
-    cpm_range_counts = history.groupby(['user_id', 'cpm_range']).size().unstack(fill_value=0)
-    cpm_range_counts.columns = [f'cpm_range_{col}_count' for col in cpm_range_counts.columns]
-    cpm_range_counts = cpm_range_counts.reset_index()
+def assemble_user_features(users, user_activity, histograms, histogram_columns):
+    """Join per-user activity aggregates and histograms onto the user table in one step"""
+    # Basic demographic features
+    users['age_group'] = pd.cut(users['age'],
+                                bins=[-1, 0, 18, 25, 35, 45, 100],
+                                labels=['unknown', '<18', '18-25', '26-35', '36-45', '45+'])
 
-    # Combine all user features
     user_features = users.merge(user_activity, on='user_id', how='left')
-    user_features = user_features.merge(publisher_counts, on='user_id', how='left')
-    user_features = user_features.merge(hour_counts, on='user_id', how='left')
-    user_features = user_features.merge(weekday_counts, on='user_id', how='left')
-    user_features = user_features.merge(cpm_range_counts, on='user_id', how='left')
 
     # Fill NA values
     numeric_cols = user_features.select_dtypes(include=[np.number]).columns
     user_features[numeric_cols] = user_features[numeric_cols].fillna(0)
 
+    # Histogram rows already follow the users order
+    histogram_frame = pd.DataFrame(histograms.toarray(), columns=histogram_columns, index=user_features.index)
+
+    # Which publishers, hours and weekdays a user was seen on, as integer bitmasks
+    masks = {f'publisher_mask_{word}': values
+             for word, values in enumerate(histogram_bitmask(histograms, histogram_columns, 'publisher'))}
+    masks['hour_mask'] = histogram_bitmask(histograms, histogram_columns, 'hour')[0].astype(np.int32)
+    masks['weekday_mask'] = histogram_bitmask(histograms, histogram_columns, 'weekday')[0].astype(np.int8)
+    mask_frame = pd.DataFrame(masks, index=user_features.index)
+
+    user_features = pd.concat([user_features, histogram_frame, mask_frame], axis=1)
+    # Bit positions of publisher_mask_<n>, in histogram column order
+    user_features.attrs['publishers'] = [col[len('publisher_'):-len('_count')] for col in histogram_columns
+                                         if col.startswith('publisher_')]
     return user_features
 
 
-def create_ad_features(validate, history):
+def create_ad_features(validate, history, auction_index=None):
     """Create features for each ad campaign scenario in the validation set"""
-    ad_features = []
-
-    for idx, row in validate.iterrows():
-        cpm = row['cpm']
-        hour_start = row['hour_start']
-        hour_end = row['hour_end']
-        publishers = row['publishers'].split(',')
-        user_ids = row['user_ids']
-        audience_size = row['audience_size']
-
-        # Time window features
-        time_window = hour_end - hour_start
-        hours_covered = list(range(hour_start % 24, (hour_end % 24) + 1))  # Accounting for hours wrapping around
-
-        # Win probability based on historical data
-        win_prob_by_publisher = {}
-        for pub in publishers:
-            pub_history = history[history['publisher'] == pub]
-            if len(pub_history) > 0:
-                higher_cpm_count = sum(pub_history['cpm'] > cpm)
-                equal_cpm_count = sum(pub_history['cpm'] == cpm)
-                total_count = len(pub_history)
-
-                if higher_cpm_count == 0:
-                    if equal_cpm_count > 1:  # Including itself
-                        win_prob_by_publisher[pub] = 0.5
-                    else:
-                        win_prob_by_publisher[pub] = 1.0
-                else:
-                    win_prob_by_publisher[pub] = 0.0
-            else:
-                win_prob_by_publisher[pub] = 0.5  # Default if no data
-
-        avg_win_prob = sum(win_prob_by_publisher.values()) / len(win_prob_by_publisher)
-
-        # Coverage statistics
-        rel_price = cpm / history['cpm'].median()
-
-        ad_features.append({
-            'idx': idx,
-            'cpm': cpm,
-            'hour_start': hour_start,
-            'hour_end': hour_end,
-            'time_window': time_window,
-            'publisher_count': len(publishers),
-            'publishers': ','.join(publishers),
-            'audience_size': audience_size,
-            'avg_win_probability': avg_win_prob,
-            'relative_price': rel_price,
-            'hours_covered': ','.join(map(str, hours_covered)),
-            'hour_count': len(hours_covered)
-        })
-
-    ad_features_df = pd.DataFrame(ad_features)
+    if auction_index is None:
+        auction_index = AuctionIndex.from_history(history)
+
+    cpm = validate['cpm'].values
+    hour_start = validate['hour_start'].values
+    hour_end = validate['hour_end'].values
+    publishers = validate['publishers'].str.split(',')
+
+    # Win probability based on historical data, answered for all tasks at once
+    avg_win_prob = auction_index.task_win_probability(cpm, publishers)
+
+    # Coverage statistics
+    rel_price = cpm / auction_index.median_cpm()
+
+    # Hours of each weekday x hour-of-day slot inside the window (wraps midnight, spans days)
+    coverage = window_coverage(hour_start, hour_end)
+
+    ad_features_df = pd.DataFrame({
+        'idx': validate.index,
+        'cpm': cpm,
+        'hour_start': hour_start,
+        'hour_end': hour_end,
+        'time_window': hour_end - hour_start,
+        'publisher_count': publishers.str.len().values,
+        'publishers': publishers.str.join(',').values,
+        'audience_size': validate['audience_size'].values,
+        'avg_win_probability': avg_win_prob,
+        'relative_price': rel_price,
+        'hour_count': coverage.sum(axis=1),
+        **{f'coverage_hour_{hour}': counts for hour, counts in enumerate(hour_of_day_coverage(coverage).T)},
+        **{f'coverage_weekday_{day}': counts for day, counts in enumerate(weekday_coverage(coverage).T)},
+    })
     return ad_features_df
 
 
-def simulate_ad_view_probabilities(users, history, validate, ad_features):
+def simulate_ad_view_probabilities(validate, simulation_tables, auction_index,
+                                   max_campaigns=None, max_users=None, seed=42, n_jobs=1):
     """
     Simulate probabilistic ad viewing based on auction mechanics and user behavior
     to generate training examples for our model
     """
+    return simulate_campaigns(validate, simulation_tables, auction_index,
+                              max_campaigns=max_campaigns, max_users=max_users, seed=seed, n_jobs=n_jobs)
 
-    def simulate_ad_view_probabilities(users, history, validate, ad_features):
-        """Optimized version of the simulation function"""
-        # Use a smaller sample of the validation set
-        sample_indices = np.random.choice(validate.index, min(30, len(validate)), replace=False)
-        simulated_results = []
-
-        # Pre-compute some statistics to avoid repetitive calculations
-        publisher_stats = {}
-        for pub in history['publisher'].unique():
-            pub_data = history[history['publisher'] == pub]
-            publisher_stats[pub] = {
-                'hour_counts': pub_data['hour_of_day'].value_counts(normalize=True).to_dict(),
-                'cpm_percentiles': np.percentile(pub_data['cpm'], [25, 50, 75, 90, 95, 99])
-            }
-
-        # Pre-compute user preferences
-        user_preferences = {}
-        for user_id in history['user_id'].unique():
-            user_data = history[history['user_id'] == user_id]
-            if len(user_data) > 0:
-                user_preferences[user_id] = {
-                    'pubs': user_data['publisher'].value_counts(normalize=True).to_dict(),
-                    'hours': user_data['hour_of_day'].value_counts(normalize=True).to_dict()
-                }
-
-        for idx in tqdm(sample_indices, desc="Simulating ad campaigns"):
-            ad_row = validate.loc[idx]
-            ad_feat_row = ad_features[ad_features['idx'] == idx].iloc[0]
-
-            cpm = ad_row['cpm']
-            hour_start = ad_row['hour_start']
-            hour_end = ad_row['hour_end']
-            publishers = ad_row['publishers'].split(',')
-            user_ids = ad_row['user_ids']
-
-            # Sample some users to make computation tractable
-            sample_size = min(1000, len(user_ids))
-            sampled_users = np.random.choice(user_ids, sample_size, replace=False)
-
-            user_view_counts = {user_id: 0 for user_id in sampled_users}
-
-            # For each user, simulate their ad viewing behavior
-            for user_id in sampled_users:
-                user_history = history[history['user_id'] == user_id]
-
-                if len(user_history) == 0:
-                    # No history for this user, use general statistics
-                    view_probability = ad_feat_row['avg_win_probability'] * 0.5  # Conservative estimate
-                    views = np.random.binomial(ad_feat_row['hour_count'], view_probability)
-                    user_view_counts[user_id] = views
-                    continue
-
-                # Analyze user's publisher preferences
-                user_pubs = user_history['publisher'].value_counts().to_dict()
-                total_views = sum(user_pubs.values())
-                user_pub_probs = {pub: count / total_views for pub, count in user_pubs.items()}
-
-                # Analyze user's time of day preferences
-                user_hours = user_history['hour_of_day'].value_counts().to_dict()
-                total_hours = sum(user_hours.values())
-                user_hour_probs = {hour: count / total_hours for hour, count in user_hours.items()}
-
-                # Simulate views based on user's preferences and ad parameters
-                hours_covered = list(range(hour_start % 24, (hour_end % 24) + 1))
-
-                views = 0
-                current_session = None
-                session_ads = set()
-
-                for h in hours_covered:
-                    hour_prob = user_hour_probs.get(h, 0.01)  # Default low probability if no history
-
-                    for pub in publishers:
-                        if pub in user_pub_probs:
-                            pub_prob = user_pub_probs[pub]
-                        else:
-                            pub_prob = 0.01  # Default low probability
-
-                        # Win auction probability based on CPM
-                        pub_history = history[(history['publisher'] == pub) & (history['hour_of_day'] == h)]
-                        if len(pub_history) > 0:
-                            higher_cpm = sum(pub_history['cpm'] > cpm)
-                            equal_cpm = sum(pub_history['cpm'] == cpm)
-
-                            if higher_cpm == 0:
-                                if equal_cpm > 1:
-                                    win_prob = 0.5
-                                else:
-                                    win_prob = 1.0
-                            else:
-                                win_prob = 0.0
-                        else:
-                            win_prob = 0.5  # Default
-
-                        # Combined probability
-                        overall_prob = hour_prob * pub_prob * win_prob
-
-                        # Simulate viewing
-                        if np.random.random() < overall_prob:
-                            # Check session logic - ads aren't shown twice in same session
-                            if current_session is None or np.random.random() < 0.2:  # 20% chance of new session
-                                current_session = f"sim_{user_id}_{h}"
-                                session_ads = set()
-
-                            ad_key = f"ad_{idx}"
-                            if ad_key not in session_ads:
-                                views += 1
-                                session_ads.add(ad_key)
-
-                user_view_counts[user_id] = views
-
-            # Calculate probabilities
-            at_least_one = sum(1 for v in user_view_counts.values() if v >= 1) / len(user_view_counts)
-            at_least_two = sum(1 for v in user_view_counts.values() if v >= 2) / len(user_view_counts)
-            at_least_three = sum(1 for v in user_view_counts.values() if v >= 3) / len(user_view_counts)
-
-            simulated_results.append({
-                'idx': idx,
-                'at_least_one': at_least_one,
-                'at_least_two': at_least_two,
-                'at_least_three': at_least_three
-            })
-
-        return pd.DataFrame(simulated_results)
 
 def prepare_training_data(validate, ad_features, user_features, simulated_results):
     """
     Prepare training data by combining ad features with user features
     """
-    # Для хранения примеров обучения
-    training_examples = []
-
-    for idx, row in validate.iterrows():
-        ad_feat = ad_features[ad_features['idx'] == idx].iloc[0]
-
-        # Получение всех пользователей аудитории
-        audience_users = row['user_ids']
-        audience_users_df = user_features[user_features['user_id'].isin(audience_users)]
-
-        # Расчет статистики по аудитории
-        audience_stats = {}
-
-        # Демографические статистики
-        for demo_col in ['sex', 'age_group', 'city_id']:
-            if demo_col in audience_users_df.columns:
-                value_counts = audience_users_df[demo_col].value_counts(normalize=True).to_dict()
-                for val, prop in value_counts.items():
-                    audience_stats[f'audience_{demo_col}_{val}_prop'] = prop
-
-        # Статистика по числовым признакам
-        numeric_cols = audience_users_df.select_dtypes(include=[np.number]).columns
-        for col in numeric_cols:
-            if col not in ['user_id', 'age']:
-                audience_stats[f'audience_{col}_mean'] = audience_users_df[col].mean()
-                audience_stats[f'audience_{col}_median'] = audience_users_df[col].median()
-                audience_stats[f'audience_{col}_std'] = audience_users_df[col].std()
-
-        # Статистика по совпадению с издателем
-        ad_publishers = set(row['publishers'].split(','))
-
-        # Поиск колонки с информацией о издателе
-        publisher_col = None
-        for col in audience_users_df.columns:
-            if 'publisher' in col.lower() and audience_users_df[col].dtype == object:
-                publisher_col = col
-                break
-
-        if publisher_col:
-            audience_users_df['publisher_match'] = audience_users_df[publisher_col].apply(
-                lambda x: len(set(str(x).split(',')) & ad_publishers) > 0 if isinstance(x, str) else False
-            )
-            audience_stats['audience_publisher_match_prop'] = audience_users_df['publisher_match'].mean()
-        else:
-            # На случай отсутствия колонки
-            audience_stats['audience_publisher_match_prop'] = 0.0
+    # Статистика по аудитории всех заданий сразу: индексация по матрице признаков пользователей
+    if not isinstance(user_features, UserFeatureMatrix):
+        user_features = UserFeatureMatrix(user_features)
+    audience_stats = user_features.batch_audience_stats(validate['user_ids'].tolist(),
+                                                      validate['publishers'].str.split(',').tolist())
 
-        # Комбинирование с признаками объявления
-        example = {**ad_feat.to_dict(), **audience_stats}
+    # Комбинирование с признаками объявления
+    training_data = pd.concat([ad_features.reset_index(drop=True), audience_stats], axis=1)
 
-        # Добавление таргета при наличии
-        if simulated_results is not None and 'idx' in simulated_results.columns:
-            if idx in simulated_results['idx'].values:
-                sim_row = simulated_results[simulated_results['idx'] == idx].iloc[0]
-                example['at_least_one'] = sim_row['at_least_one']
-                example['at_least_two'] = sim_row['at_least_two']
-                example['at_least_three'] = sim_row['at_least_three']
+    # Добавление таргета при наличии
+    if simulated_results is not None and 'idx' in simulated_results.columns:
+        training_data = training_data.merge(simulated_results[['idx'] + TARGET_COLS], on='idx', how='left')
 
-        training_examples.append(example)
+    return training_data
 
-    return pd.DataFrame(training_examples)
 
-def train_models(training_data, validate_answers):
+def training_targets(training_data, multi_target=False):
     """
-    Train separate models for each target using CatBoost
+    Labeled rows and labels of every model to fit: one per available target, or
+    a single multi-target model of the conditional ratios (only campaigns that
+    were simulated carry a target)
+    """
+    available_targets = [col for col in TARGET_COLS if col in training_data.columns]
+    if multi_target:
+        labeled_rows = np.flatnonzero(training_data[TARGET_COLS].notna().all(axis=1).to_numpy())
+        return {MULTI_TARGET: (labeled_rows, conditional_ratios(training_data[TARGET_COLS].fillna(0)))}
+
+    return {target: (np.flatnonzero(training_data[target].notna().to_numpy()), training_data[target])
+            for target in available_targets}
+
+
+def model_params(params, multi_target=False):
+    if multi_target:
+        return {**params, 'loss_function': 'MultiRMSE', 'eval_metric': 'MultiRMSE'}
+    return {**params, 'loss_function': 'RMSE', 'eval_metric': 'RMSE'}
+
+
+def validation_metrics(training_data, target, val_rows, val_preds):
+    """Metric of each at_least_* target predicted by one fitted model on its validation rows"""
+    if target == MULTI_TARGET:
+        predictions = dict(zip(TARGET_COLS, chain_ratios(val_preds).T))
+    else:
+        predictions = {target: val_preds}
+    return {name: smoothed_log_accuracy_ratio(training_data[name].to_numpy()[val_rows], preds, EPS)
+            for name, preds in predictions.items()}
+
+
+def train_models(training_data, validate_answers, n_jobs=1, multi_target=False, measure_speedup=False):
+    """
+    Train separate models for each target using CatBoost, or a single MultiRMSE
+    model of the conditional ratios whose chained predictions keep
+    at_least_one >= at_least_two >= at_least_three
     """
     models = {}
     importances = {}
@@ -444,50 +308,41 @@ def train_models(training_data, validate_answers):
                 for target in TARGET_COLS:
                     training_data.loc[idx, target] = validate_answers.loc[idx, target]
 
-        available_targets = TARGET_COLS
-
     # Determine features
-    exclude_cols = TARGET_COLS + ['idx', 'publishers', 'hours_covered']
+    exclude_cols = TARGET_COLS + ['idx', 'publishers']
     feature_cols = [col for col in training_data.columns if col not in exclude_cols]
 
     # Handle categorical features
     cat_features = [i for i, col in enumerate(feature_cols) if training_data[col].dtype == 'object']
 
-    for target in available_targets:
-        print(f"\nTraining model for {target}")
-
-        # Prepare data
-        X = training_data[feature_cols]
-        y = training_data[target].fillna(0)
-
-        # Split data
-        X_train, X_val, y_train, y_val = train_test_split(X, y, test_size=0.2, random_state=42)
-
-        # Create CatBoost Pool with categorical features
-        train_pool = Pool(X_train, y_train, cat_features=cat_features)
-        val_pool = Pool(X_val, y_val, cat_features=cat_features)
-
-        # Train model
-        model = CatBoostRegressor(
-            iterations=1000,
-            learning_rate=0.03,
-            depth=6,
-            loss_function='RMSE',
-            eval_metric='RMSE',
-            random_seed=42,
-            verbose=100
-        )
-
-        model.fit(train_pool, eval_set=val_pool, early_stopping_rounds=50)
-
+    params = model_params({
+        'iterations': 1000,
+        'learning_rate': 0.03,
+        'depth': 6,
+        'random_seed': 42,
+        'verbose': 100 if n_jobs <= 1 else 0,  # Logs of concurrent fits would interleave
+    }, multi_target)
+
+    # One job per model
+    targets = training_targets(training_data, multi_target)
+    jobs = []
+    for target, (labeled_rows, _) in targets.items():
+        train_rows, val_rows = train_test_split(labeled_rows, test_size=0.2, random_state=42)
+        jobs.append((target, None, train_rows, val_rows, params))
+
+    print(f"Training models for {', '.join(targets)}")
+    results = fit_catboost_jobs(training_data[feature_cols], {target: y for target, (_, y) in targets.items()},
+                                cat_features, jobs, n_jobs, label='Final models', measure_speedup=measure_speedup)
+
+    for (target, _, _, val_rows, _), result in zip(jobs, results):
         # Evaluate
-        val_preds = model.predict(X_val)
-        val_metric = calculate_metric(y_val.values, val_preds)
-        print(f"Validation metric for {target}: {val_metric:.4f}%")
+        model = result['model']
+        for name, val_metric in validation_metrics(training_data, target, val_rows, result['val_preds']).items():
+            print(f"Validation metric for {name}: {val_metric:.4f}%")
 
         # Store model and feature importances
         models[target] = model
-        importances[target] = model.get_feature_importance(train_pool)
+        importances[target] = model.get_feature_importance()
 
         # Plot feature importances
         plt.figure(figsize=(10, 8))
@@ -509,23 +364,8 @@ def make_predictions(models, training_data, validate):
     """
     Make predictions for the validation set
     """
-    # Determine features
-    exclude_cols = TARGET_COLS + ['idx', 'publishers', 'hours_covered']
-    feature_cols = [col for col in training_data.columns if col not in exclude_cols]
-
-    # Create predictions DataFrame
-    predictions = pd.DataFrame(index=validate.index)
-
-    # Make predictions for each target
-    for target, model in models.items():
-        predictions[target] = model.predict(training_data[feature_cols])
-
-    # Clip predictions to valid range
-    for target in TARGET_COLS:
-        if target in predictions.columns:
-            predictions[target] = predictions[target].clip(0, 1)
-        else:
-            print(f"Warning: No predictions for {target}")
+    # Predictions clipped to the valid range, shared with predict.py
+    predictions = predict_targets(models, training_data).set_axis(validate.index)
 
     # Ensure all targets are present
     for target in TARGET_COLS:
@@ -539,55 +379,49 @@ def make_predictions(models, training_data, validate):
     return predictions
 
 
-def run_cross_validation(training_data, n_splits=5):
+def run_cross_validation(training_data, n_splits=5, n_jobs=1, multi_target=False, measure_speedup=False):
     """
-    Run cross-validation to get a reliable estimate of model performance
+    Run cross-validation to get a reliable estimate of model performance.
+    All model x fold fits run as concurrent jobs.
     """
     # Determine features
-    exclude_cols = TARGET_COLS + ['idx', 'publishers', 'hours_covered']
+    exclude_cols = TARGET_COLS + ['idx', 'publishers']
     feature_cols = [col for col in training_data.columns if col not in exclude_cols]
 
     # Handle categorical features
     cat_features = [i for i, col in enumerate(feature_cols) if training_data[col].dtype == 'object']
 
-    # Available targets
-    available_targets = [col for col in TARGET_COLS if col in training_data.columns]
+    targets = training_targets(training_data, multi_target)
 
-    cv_results = {}
     kf = KFold(n_splits=n_splits, shuffle=True, random_state=42)
 
-    for target in available_targets:
+    jobs = []
+    for target, (labeled_rows, _) in targets.items():
+        for fold, (train_idx, val_idx) in enumerate(kf.split(labeled_rows)):
+            params = model_params({
+                'iterations': 500,
+                'learning_rate': 0.05,
+                'depth': 6,
+                'random_seed': 42 + fold,
+                'verbose': 0,
+            }, multi_target)
+            jobs.append((target, fold, labeled_rows[train_idx], labeled_rows[val_idx], params))
+
+    results = fit_catboost_jobs(training_data[feature_cols], {target: y for target, (_, y) in targets.items()},
+                                cat_features, jobs, n_jobs, label='Cross-validation',
+                                measure_speedup=measure_speedup)
+
+    # Metrics of every at_least_* target per fold, whichever model predicted it
+    fold_metrics = {}
+    for (job_target, fold, _, val_rows, _), result in zip(jobs, results):
+        for name, val_metric in validation_metrics(training_data, job_target, val_rows, result['val_preds']).items():
+            fold_metrics.setdefault(name, []).append((fold, val_metric))
+
+    cv_results = {}
+    for target, metrics in fold_metrics.items():
         print(f"\nCross-validation for {target}")
         cv_metrics = []
-
-        # Prepare data
-        X = training_data[feature_cols]
-        y = training_data[target].fillna(0)
-
-        for fold, (train_idx, val_idx) in enumerate(kf.split(X)):
-            X_train, X_val = X.iloc[train_idx], X.iloc[val_idx]
-            y_train, y_val = y.iloc[train_idx], y.iloc[val_idx]
-
-            # Create CatBoost Pool with categorical features
-            train_pool = Pool(X_train, y_train, cat_features=cat_features)
-            val_pool = Pool(X_val, y_val, cat_features=cat_features)
-
-            # Train model
-            model = CatBoostRegressor(
-                iterations=500,
-                learning_rate=0.05,
-                depth=6,
-                loss_function='RMSE',
-                eval_metric='RMSE',
-                random_seed=42 + fold,
-                verbose=0
-            )
-
-            model.fit(train_pool, eval_set=val_pool, early_stopping_rounds=50)
-
-            # Evaluate
-            val_preds = model.predict(X_val)
-            val_metric = calculate_metric(y_val.values, val_preds)
+        for fold, val_metric in metrics:
             cv_metrics.append(val_metric)
             print(f"Fold {fold + 1}, Metric: {val_metric:.4f}%")
 
@@ -601,23 +435,8 @@ def run_cross_validation(training_data, n_splits=5):
     return cv_results
 
 
-def main():
-    # Create output directory for artifacts
-    os.makedirs('artifacts', exist_ok=True)
-
-    # 1. Load data
-    print("Loading data...")
-    users, history, validate, answers = load_data()
-
-    # 2. Preprocess history data
-    print("Preprocessing history data...")
-    history = preprocess_history(history)
-
-    # 3. Analyze auction dynamics
-    print("Analyzing auction dynamics...")
-    cpm_stats, cpm_win_probs = analyze_auction_dynamics(history)
-
-    # Save some exploratory plots
+def save_history_plots(history):
+    """Save some exploratory plots"""
     plt.figure(figsize=(12, 6))
     sns.histplot(history['cpm'], bins=50, log_scale=True)
     plt.title('Distribution of CPM values')
@@ -632,50 +451,196 @@ def main():
     plt.savefig('artifacts/cpm_by_publisher.png')
     plt.close()
 
-    # 4. Create features
-    print("Creating user features...")
-    user_features = create_user_features(users, history)
 
-    print("Creating ad features...")
-    ad_features = create_ad_features(validate, history)
+def history_feature_stages(cache, users, streaming=False, partition_mb=DEFAULT_PARTITION_MB, n_jobs=1):
+    """
+    Cached stages derived from history.tsv: user features, the
+    (auction index, simulation tables) pair and the auction statistics
+    """
+    if streaming:
+        def stream():
+            # Preprocess, analyze auctions and build user features partition by partition
+            print("Streaming history partitions...")
+            aggregate = partial(aggregate_user_activity, user_index=pd.Index(users['user_id']))
+            return stream_history_features(preprocess_history, aggregate, partition_mb=partition_mb)
+
+        streamed = cache.stage('stream_history', stream, inputs=['history.tsv', 'users.tsv'],
+                               params={'partition_mb': partition_mb})
+        auction_stats = cache.stage('auction_stats', lambda: streamed.value[1], upstream=[streamed])
+        user_features = cache.stage('user_features', lambda: assemble_user_features(users, *streamed.value[0]),
+                                    inputs=['users.tsv'], upstream=[streamed])
+        history_tables = cache.stage('history_tables', lambda: tuple(streamed.value[2:]), upstream=[streamed])
+        return user_features, history_tables, auction_stats
+
+    def preprocess():
+        print("Preprocessing history data...")
+        return preprocess_history(load_history('history.tsv'))
+
+    def analyze():
+        preprocessed = history.value
+        print("Analyzing auction dynamics...")
+        cpm_stats, cpm_win_probs = analyze_auction_dynamics(preprocessed, n_jobs)
+        save_history_plots(preprocessed)
+        return cpm_stats
+
+    def build_tables():
+        return AuctionIndex.from_history(history.value), SimulationTables.from_history(history.value)
+
+    history = cache.stage('preprocess_history', preprocess, inputs=['history.tsv'])
+    auction_stats = cache.stage('auction_stats', analyze, upstream=[history])
+    user_features = cache.stage('user_features', lambda: create_user_features(users, history.value),
+                                inputs=['users.tsv'], upstream=[history])
+    history_tables = cache.stage('history_tables', build_tables, upstream=[history])
+    return user_features, history_tables, auction_stats
+
+
+STAGE_NAMES = ['preprocess_history', 'stream_history', 'auction_stats', 'user_features', 'history_tables',
+               'ad_features', 'simulation', 'training_data']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Ad views forecasting pipeline')
+    parser.add_argument('--model', choices=['catboost', 'analytical'], default='catboost',
+                        help='catboost trains on simulated campaigns, analytical is the closed-form '
+                             'reach estimate (no training)')
+    parser.add_argument('--streaming', action='store_true',
+                        help='process history.tsv out-of-core in user partitions (bounded memory)')
+    parser.add_argument('--partition-mb', type=float, default=DEFAULT_PARTITION_MB,
+                        help='approximate size of one history partition in streaming mode')
+    parser.add_argument('--multi-target', action='store_true',
+                        help='fit one MultiRMSE CatBoost model of the conditional ratios at_least_two / '
+                             'at_least_one and at_least_three / at_least_two instead of one model per target')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(),
+                        help='worker processes for the CPM sketches, the campaign simulation and CatBoost fits')
+    parser.add_argument('--measure-speedup', action='store_true',
+                        help='refit the CatBoost models one at a time after the parallel fit and report the '
+                             'wall-clock speedup of --jobs (doubles training time)')
+    parser.add_argument('--sim-campaigns', type=int, default=None,
+                        help='simulate only a random sample of this many campaigns (default: all)')
+    parser.add_argument('--sim-users', type=int, default=None,
+                        help='simulate at most this many audience members per campaign (default: all)')
+    parser.add_argument('--invalidate', nargs='+', default=[], choices=STAGE_NAMES + ['all'], metavar='STAGE',
+                        help='recompute these cached stages and everything downstream of them '
+                             f'({", ".join(STAGE_NAMES)} or all)')
+    parser.add_argument('--no-cache', action='store_true', help='do not read or write the stage cache')
+    parser.add_argument('--profile', action='store_true',
+                        help='also run every stage under cProfile and dump the stats to artifacts/profiles/')
+    parser.add_argument('--profile-report', default=None, metavar='PATH',
+                        help='where to write the JSON stage timing report '
+                             '(default: artifacts/profile_<timestamp>.json)')
+    return parser.parse_args()
+
+
+def evaluate_predictions(answers, predictions):
+    # Same metric as metrics.py: the overall figure averages log ratios, not per-target percentages
+    log_ratios = log_accuracy_ratios(answers[TARGET_COLS], predictions[TARGET_COLS], EPS)
+    for pos, target in enumerate(TARGET_COLS):
+        print(f"Metric for {target}: {percentage_error(log_ratios[:, pos].mean()):.4f}%")
+
+    overall_metric = overall_score(log_ratios)
+    print(f"Overall metric: {overall_metric:.4f}%")
+
+
+def run_analytical(validate, answers, history_tables):
+    """Closed-form reach estimate for every task, evaluated and saved like the CatBoost predictions"""
+    auction_index, simulation_tables = history_tables.value
+    print("Estimating reach analytically...")
+    predictions = estimate_reach(validate, simulation_tables, auction_index)[TARGET_COLS]
+
+    evaluate_predictions(answers, predictions)
+
+    predictions.to_csv('analytical_predictions.tsv', sep='\t', index=False)
+    print("Predictions saved to analytical_predictions.tsv")
+
+
+def run_pipeline(args, profiler):
+    cache = StageCache(invalidate=args.invalidate, enabled=not args.no_cache, profiler=profiler)
+
+    # 1. Load data (history itself is only read by stages that are not cached)
+    print("Loading data...")
+    with profiler.stage('load_data') as record:
+        users, _, validate, answers = load_data(with_history=False)
+        record['rows'] = len(validate)
+
+    # 2-4. Preprocess history, analyze auction dynamics and create user features
+    user_features, history_tables, auction_stats = history_feature_stages(
+        cache, users, streaming=args.streaming, partition_mb=args.partition_mb, n_jobs=args.jobs)
+
+    if args.model == 'analytical':
+        with profiler.stage('analytical', rows=len(validate)):
+            run_analytical(validate, answers, history_tables)
+        return
+
+    cpm_stats = auction_stats.value
+
+    def ad_features_stage():
+        print("Creating ad features...")
+        auction_index, _ = history_tables.value
+        return create_ad_features(validate, None, auction_index)
 
     # 5. Simulate ad views for training data
-    print("Simulating ad views...")
-    simulated_results = simulate_ad_view_probabilities(users, history, validate, ad_features)
+    def simulation_stage():
+        print("Simulating ad views...")
+        auction_index, simulation_tables = history_tables.value
+        return simulate_ad_view_probabilities(validate, simulation_tables, auction_index,
+                                              max_campaigns=args.sim_campaigns, max_users=args.sim_users,
+                                              n_jobs=args.jobs)
 
     # 6. Prepare training data
-    print("Preparing training data...")
-    training_data = prepare_training_data(validate, ad_features, user_features, simulated_results)
+    def training_data_stage():
+        inputs = ad_features.value, user_features.value, simulated_results.value
+        print("Preparing training data...")
+        return prepare_training_data(validate, *inputs)
+
+    ad_features = cache.stage('ad_features', ad_features_stage, inputs=['validate.tsv'], upstream=[history_tables])
+    simulated_results = cache.stage('simulation', simulation_stage, inputs=['validate.tsv'],
+                                    params={'sim_campaigns': args.sim_campaigns, 'sim_users': args.sim_users},
+                                    upstream=[history_tables])
+    training_data = cache.stage('training_data', training_data_stage,
+                                upstream=[ad_features, user_features, simulated_results]).value
 
     # 7. Run cross-validation
     print("Running cross-validation...")
-    cv_results = run_cross_validation(training_data)
+    with profiler.stage('cross_validation', rows=len(training_data)):
+        cv_results = run_cross_validation(training_data, n_jobs=args.jobs, multi_target=args.multi_target,
+                                          measure_speedup=args.measure_speedup)
 
     # 8. Train final models
     print("Training final models...")
-    models, importances = train_models(training_data, answers)
+    with profiler.stage('train_models', rows=len(training_data)):
+        models, importances = train_models(training_data, answers, n_jobs=args.jobs,
+                                           multi_target=args.multi_target, measure_speedup=args.measure_speedup)
 
     # 9. Make predictions
     print("Making predictions...")
-    predictions = make_predictions(models, training_data, validate)
+    predictions = profiler.call('make_predictions', make_predictions, models, training_data, validate)
 
     # 10. Evaluate against validation answers
-    metric_values = []
-    for target in TARGET_COLS:
-        metric = calculate_metric(answers[target].values, predictions[target].values)
-        metric_values.append(metric)
-        print(f"Metric for {target}: {metric:.4f}%")
-
-    overall_metric = np.mean(metric_values)
-    print(f"Overall metric: {overall_metric:.4f}%")
+    evaluate_predictions(answers, predictions)
 
     # 11. Save models and predictions
-    with open('artifacts/models.pkl', 'wb') as f:
-        pickle.dump(models, f)
+    with profiler.stage('save_outputs', rows=len(predictions)):
+        with open('artifacts/models.pkl', 'wb') as f:
+            pickle.dump(models, f)
 
-    predictions.to_csv('predictions.tsv', sep='\t', index=False)
+        predictions.to_csv('predictions.tsv', sep='\t', index=False)
     print("Predictions saved to predictions.tsv")
 
 
+def main():
+    args = parse_args()
+
+    # Create output directory for artifacts
+    os.makedirs('artifacts', exist_ok=True)
+
+    profiler = StageProfiler(profile=args.profile)
+    try:
+        run_pipeline(args, profiler)
+    finally:
+        # Report the stages that ran even when a later one failed
+        profiler.print_summary()
+        print(f"Stage profile saved to {profiler.write_report(args.profile_report)}")
+
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
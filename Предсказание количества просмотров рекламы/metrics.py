@@ -1,45 +1,149 @@
-import sys
+import argparse
 
 import pandas as pd
 import numpy as np
 
+TARGET_COLUMNS = ['at_least_one', 'at_least_two', 'at_least_three']
+EPSILON = 0.005
+
+DEFAULT_BOOTSTRAP_BATCH = 500  # Resamples per weight matrix, bounds memory to batch x rows
+
+# Segment edges for the per-segment breakdown
+AUDIENCE_SIZE_BINS = [0, 100, 500, 1000, 5000, np.inf]
+CPM_BINS = [0, 10, 50, 100, 500, 1000, np.inf]
+PUBLISHER_COUNT_BINS = [0, 1, 2, 4, np.inf]
+
 
 def load_answers(answers_filename):
-    return pd.read_csv(answers_filename, sep="\t")
+    return pd.read_csv(answers_filename, sep="\t", usecols=TARGET_COLUMNS, dtype=np.float64)
+
+
+def log_accuracy_ratios(answers, responses, epsilon=EPSILON):
+    """|log((response + eps) / (answer + eps))| per row and column, as an array"""
+    answers = np.asarray(answers, dtype=np.float64)
+    responses = np.asarray(responses, dtype=np.float64)
+    return np.abs(np.log((responses + epsilon) / (answers + epsilon)))
+
+
+def percentage_error(mean_log_ratio):
+    return 100 * (np.exp(mean_log_ratio) - 1)
+
+
+def overall_score(log_ratios, axis=None):
+    """Task metric: percentage of the mean log ratio over all rows and targets"""
+    return percentage_error(np.mean(log_ratios, axis=axis))
+
+
+def smoothed_log_accuracy_ratio(y_true, y_pred, epsilon=EPSILON):
+    """Smoothed mean log accuracy ratio of a single target, in percent"""
+    return percentage_error(log_accuracy_ratios(y_true, y_pred, epsilon).mean())
 
 
 def get_smoothed_log_mape_column_value(responses_column, answers_column, epsilon):
-    return np.abs(np.log(
-        (responses_column + epsilon)
-        / (answers_column + epsilon)
-    )).mean()
+    return log_accuracy_ratios(answers_column, responses_column, epsilon).mean()
 
 
 def get_smoothed_mean_log_accuracy_ratio(answers, responses, epsilon=0.005):
-    log_accuracy_ratio_mean = np.array(
-        [
-            get_smoothed_log_mape_column_value(responses.at_least_one, answers.at_least_one, epsilon),
-            get_smoothed_log_mape_column_value(responses.at_least_two, answers.at_least_two, epsilon),
-            get_smoothed_log_mape_column_value(responses.at_least_three, answers.at_least_three, epsilon),
-        ]
-    ).mean()
-
-    percentage_error = 100 * (np.exp(log_accuracy_ratio_mean) - 1)
+    log_accuracy_ratio_mean = log_accuracy_ratios(answers[TARGET_COLUMNS], responses[TARGET_COLUMNS],
+                                                  epsilon).mean(axis=0).mean()
 
-    return percentage_error.round(
+    return percentage_error(log_accuracy_ratio_mean).round(
         decimals=2
     )
 
 
+def bootstrap_scores(log_ratios, n_resamples=2000, seed=42, batch=DEFAULT_BOOTSTRAP_BATCH):
+    """
+    Metric of `n_resamples` bootstrap resamples of the rows for each response.
+    `log_ratios` has shape (responses, rows, targets). Every resample is a row of
+    multinomial counts, so a whole batch of resamples is one matrix multiply,
+    and all responses are scored on the same resamples (paired comparison).
+    Returns an array of shape (responses, n_resamples).
+    """
+    n_responses, n_rows, _ = log_ratios.shape
+    row_means = log_ratios.mean(axis=2).T  # (rows, responses): mean over targets
+    rng = np.random.default_rng(seed)
+
+    scores = np.empty((n_responses, n_resamples))
+    for start in range(0, n_resamples, batch):
+        size = min(batch, n_resamples - start)
+        weights = rng.multinomial(n_rows, np.full(n_rows, 1 / n_rows), size=size)
+        scores[:, start:start + size] = (weights @ row_means / n_rows).T
+    return percentage_error(scores)
+
+
+def segment_labels(tasks):
+    """Audience size, CPM and publisher count buckets of each task"""
+    return {
+        'audience_size': pd.cut(tasks['audience_size'], AUDIENCE_SIZE_BINS, right=False),
+        'cpm': pd.cut(tasks['cpm'], CPM_BINS),
+        'publisher_count': pd.cut(tasks['publishers'].str.count(',') + 1, PUBLISHER_COUNT_BINS),
+    }
+
+
+def segment_breakdown(tasks, log_ratios, names):
+    """Metric of every response within each segment, one row per (segment, bucket)"""
+    row_means = pd.DataFrame(log_ratios.mean(axis=2).T, columns=names)
+    tables = []
+    for segment, labels in segment_labels(tasks).items():
+        grouped = row_means.groupby(labels.to_numpy(), observed=True)
+        table = percentage_error(grouped.mean()).round(2)
+        table.insert(0, 'rows', grouped.size())
+        table.index = pd.MultiIndex.from_product([[segment], table.index], names=['segment', 'bucket'])
+        tables.append(table)
+    return pd.concat(tables)
+
+
+def score_files(answers_filename, responses_filenames, n_bootstrap=0, tasks_filename=None, seed=42):
+    """Score several response files against one answers file"""
+    answers = load_answers(answers_filename).to_numpy()
+    log_ratios = np.stack([log_accuracy_ratios(answers, load_answers(name).to_numpy())
+                           for name in responses_filenames])
+
+    summary = pd.DataFrame(index=pd.Index(responses_filenames, name='responses'))
+    for pos, target in enumerate(TARGET_COLUMNS):
+        summary[target] = percentage_error(log_ratios[:, :, pos].mean(axis=1))
+    summary['score'] = overall_score(log_ratios, axis=(1, 2))
+
+    if n_bootstrap:
+        scores = bootstrap_scores(log_ratios, n_bootstrap, seed)
+        summary['ci_low'], summary['ci_high'] = np.percentile(scores, [2.5, 97.5], axis=1)
+        # Paired difference to the first file: the same resamples score every file
+        summary['p_better_than_first'] = (scores < scores[:1]).mean(axis=1)
+
+    breakdown = None
+    if tasks_filename is not None:
+        tasks = pd.read_csv(tasks_filename, sep='\t', usecols=['cpm', 'publishers', 'audience_size'])
+        breakdown = segment_breakdown(tasks, log_ratios, responses_filenames)
+    return summary.round(2), breakdown
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Smoothed Mean Log Accuracy Ratio of prediction files')
+    parser.add_argument('answers', help='answers TSV, e.g. validate_answers.tsv')
+    parser.add_argument('responses', nargs='+', help='one or more prediction TSVs')
+    parser.add_argument('--bootstrap', type=int, default=0, metavar='N',
+                        help='add 95%% bootstrap intervals from N resamples')
+    parser.add_argument('--tasks', default=None, help='tasks TSV (validate.tsv) for per-segment breakdowns')
+    parser.add_argument('--seed', type=int, default=42)
+    return parser.parse_args()
+
+
 def main():
-    answers_filename = sys.argv[1]
-    responses_filename = sys.argv[2]
+    args = parse_args()
 
-    answers = load_answers(answers_filename)
-    responses = load_answers(responses_filename)
+    if len(args.responses) == 1 and not args.bootstrap and args.tasks is None:
+        answers = load_answers(args.answers)
+        responses = load_answers(args.responses[0])
+        print(get_smoothed_mean_log_accuracy_ratio(answers, responses))
+        return
 
-    print(get_smoothed_mean_log_accuracy_ratio(answers, responses))
+    summary, breakdown = score_files(args.answers, args.responses, args.bootstrap, args.tasks, args.seed)
+    print(summary.to_string())
+    if breakdown is not None:
+        print()
+        print(breakdown.to_string())
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,83 @@
+import argparse
+import contextlib
+import pickle
+import sys
+
+import numpy as np
+import pandas as pd
+
+from audience import UserFeatureMatrix
+from main import TARGET_COLS, create_ad_features, history_feature_stages, parse_user_ids, prepare_training_data
+from stage_cache import StageCache
+from streaming import DEFAULT_PARTITION_MB
+from training import predict_targets
+
+DEFAULT_BATCH_SIZE = 10_000
+DEFAULT_MODELS_PATH = 'artifacts/models.pkl'
+
+
+def load_models(path=DEFAULT_MODELS_PATH):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def load_feature_state(streaming=False, partition_mb=DEFAULT_PARTITION_MB, user_features_path=None):
+    """
+    User feature matrix and auction index from the stage cache written by main.py.
+    Stages missing from the cache are computed (and cached) from history.tsv.
+    `user_features_path` points at user features refreshed by user_state.py instead.
+    """
+    users = pd.read_csv('users.tsv', sep='\t', dtype={'user_id': np.int32})
+    user_features, history_tables, _ = history_feature_stages(StageCache(), users, streaming=streaming,
+                                                              partition_mb=partition_mb)
+    auction_index, _ = history_tables.value
+    user_features = pd.read_pickle(user_features_path) if user_features_path else user_features.value
+    return UserFeatureMatrix(user_features), auction_index
+
+
+def predict_batch(models, tasks, user_matrix, auction_index):
+    """Predict at_least_* for a batch of validate-format tasks (user_ids already parsed)"""
+    ad_features = create_ad_features(tasks, None, auction_index)
+    features = prepare_training_data(tasks, ad_features, user_matrix, None)
+
+    return predict_targets(models, features)[TARGET_COLS].set_axis(tasks.index)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Predict ad views for a tasks file with the saved models')
+    parser.add_argument('tasks', help='tasks TSV in the validate.tsv format')
+    parser.add_argument('--output', default=None, help='write predictions here instead of stdout')
+    parser.add_argument('--models', default=DEFAULT_MODELS_PATH, help='models saved by main.py')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help='tasks scored at once')
+    parser.add_argument('--streaming', action='store_true',
+                        help='use the features of a streaming-mode run of main.py')
+    parser.add_argument('--partition-mb', type=float, default=DEFAULT_PARTITION_MB,
+                        help='partition size of that streaming-mode run')
+    parser.add_argument('--user-features', default=None,
+                        help='user features refreshed by user_state.py (default: the stage cache)')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    models = load_models(args.models)
+    # Keep progress messages out of the predictions when they go to stdout
+    with contextlib.redirect_stdout(sys.stderr):
+        user_matrix, auction_index = load_feature_state(args.streaming, args.partition_mb, args.user_features)
+
+    output = open(args.output, 'w', encoding='utf-8', newline='') if args.output else sys.stdout
+    try:
+        header = True
+        for tasks in pd.read_csv(args.tasks, sep='\t', chunksize=args.batch_size):
+            tasks['user_ids'] = parse_user_ids(tasks['user_ids'])
+            predictions = predict_batch(models, tasks, user_matrix, auction_index)
+            predictions.to_csv(output, sep='\t', index=False, header=header)
+            header = False
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+import cProfile
+import io
+import json
+import os
+import platform
+import pstats
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # Not available on Windows: peak RSS is not reported there
+    resource = None
+
+DEFAULT_REPORT_DIR = 'artifacts'
+TOP_FUNCTIONS = 15  # Functions by cumulative time kept per stage in the report when profiling
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far, in MB (None without the resource module)"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+def children_cpu_seconds():
+    """CPU time of terminated child processes (process pool workers), 0 without the resource module"""
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def count_rows(value):
+    """Rows of a stage output: its length for DataFrames, Series and arrays, None otherwise"""
+    if isinstance(value, (pd.DataFrame, pd.Series, np.ndarray)):
+        return len(value)
+    return None
+
+
+def top_functions(profile, limit=TOP_FUNCTIONS):
+    stats = pstats.Stats(profile, stream=io.StringIO()).sort_stats('cumulative')
+    rows = []
+    for (filename, line, function), (_, calls, tottime, cumtime, _) in stats.stats.items():
+        rows.append({'function': f'{os.path.basename(filename)}:{line}({function})', 'calls': calls,
+                     'tottime': round(tottime, 4), 'cumtime': round(cumtime, 4)})
+    return sorted(rows, key=lambda row: row['cumtime'], reverse=True)[:limit]
+
+
+class StageProfiler:
+    """
+    Wall time, CPU time, peak RSS and row counts of every pipeline stage.
+
+    Stages nest: a stage that triggers another one (e.g. a cached stage
+    computing its upstream) reports both its total time and its self time
+    without the nested stages. With `profile=True` every stage also runs under
+    cProfile, its stats are dumped to a .prof file (for snakeviz, pstats, ...)
+    and its slowest functions are kept in the JSON report.
+    """
+
+    def __init__(self, profile=False, report_dir=DEFAULT_REPORT_DIR):
+        self.profile = profile
+        self.report_dir = report_dir
+        self.run_id = datetime.now().strftime('%Y%m%d-%H%M%S')
+        self.records = []
+        self._stack = []  # (record, cProfile.Profile or None) of the running stages
+        self._started = time.perf_counter()
+
+    @property
+    def profile_dir(self):
+        return os.path.join(self.report_dir, 'profiles', self.run_id)
+
+    @contextmanager
+    def stage(self, name, rows=None):
+        """
+        Measure the enclosed block as stage `name`. The yielded record can be
+        updated inside the block, e.g. with the number of rows processed.
+        """
+        parent, parent_profile = self._stack[-1] if self._stack else (None, None)
+        record = {'id': len(self.records), 'stage': name, 'parent_id': parent['id'] if parent else None,
+                  'depth': len(self._stack), 'rows': rows}
+        self.records.append(record)
+
+        profile = None
+        if self.profile:
+            # Only one profiler can be active: pause the enclosing stage's one so each stage profiles itself
+            if parent_profile is not None:
+                parent_profile.disable()
+            profile = cProfile.Profile()
+            profile.enable()
+        self._stack.append((record, profile))
+
+        wall, cpu, child_cpu = time.perf_counter(), time.process_time(), children_cpu_seconds()
+        rss_before = peak_rss_mb()
+        try:
+            yield record
+        finally:
+            record['wall_seconds'] = time.perf_counter() - wall
+            record['cpu_seconds'] = time.process_time() - cpu
+            record['child_cpu_seconds'] = children_cpu_seconds() - child_cpu
+            record['peak_rss_mb'] = peak_rss_mb()
+            record['peak_rss_growth_mb'] = None if rss_before is None else record['peak_rss_mb'] - rss_before
+            self._stack.pop()
+
+            if profile is not None:
+                profile.disable()
+                os.makedirs(self.profile_dir, exist_ok=True)
+                record['profile_path'] = os.path.join(self.profile_dir, f"{record['id']:02d}_{name}.prof")
+                profile.dump_stats(record['profile_path'])
+                record['top_functions'] = top_functions(profile)
+                if parent_profile is not None:
+                    parent_profile.enable()
+
+    def call(self, name, function, *args, **kwargs):
+        """Run `function` as stage `name`, counting the rows of its result"""
+        with self.stage(name) as record:
+            value = function(*args, **kwargs)
+            record['rows'] = count_rows(value)
+        return value
+
+    def _self_seconds(self, record):
+        nested = sum(child['wall_seconds'] for child in self.records
+                     if child['parent_id'] == record['id'] and 'wall_seconds' in child)
+        return record['wall_seconds'] - nested
+
+    def report(self):
+        stages = [{**record, 'self_seconds': self._self_seconds(record)} for record in self.records
+                  if 'wall_seconds' in record]
+        return {
+            'run_id': self.run_id,
+            'argv': sys.argv,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'total_wall_seconds': time.perf_counter() - self._started,
+            'peak_rss_mb': peak_rss_mb(),
+            'stages': stages,
+        }
+
+    def write_report(self, path=None):
+        """
+        Save the report as JSON, by default to artifacts/profile_<run id>.json
+        so that successive runs can be compared
+        """
+        report = self.report()
+        path = path or os.path.join(self.report_dir, f'profile_{self.run_id}.json')
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, default=str)
+        return path
+
+    def print_summary(self):
+        report = self.report()
+        print(f"{'stage':<32} {'wall s':>8} {'self s':>8} {'cpu s':>8} {'peak MB':>9} {'rows':>10}")
+        for stage in report['stages']:
+            name = '  ' * stage['depth'] + stage['stage'] + (' (cached)' if stage.get('cached') else '')
+            peak = '' if stage['peak_rss_mb'] is None else f"{stage['peak_rss_mb']:.0f}"
+            rows = '' if stage['rows'] is None else stage['rows']
+            print(f"{name:<32} {stage['wall_seconds']:>8.2f} {stage['self_seconds']:>8.2f} "
+                  f"{stage['cpu_seconds'] + stage['child_cpu_seconds']:>8.2f} {peak:>9} {rows:>10}")
+        print(f"Total {report['total_wall_seconds']:.2f}s wall-clock")
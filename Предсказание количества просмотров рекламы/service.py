@@ -0,0 +1,241 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+
+import numpy as np
+import pandas as pd
+
+from main import TARGET_COLS
+from predict import DEFAULT_MODELS_PATH, load_feature_state, load_models, predict_batch
+from streaming import DEFAULT_PARTITION_MB
+
+DEFAULT_MAX_BATCH = 64
+DEFAULT_MAX_DELAY_MS = 2.0
+LATENCY_WINDOW = 10_000  # Requests kept for the latency percentiles
+
+
+def parse_campaign(payload):
+    """
+    One validate-format task from a JSON request. publishers and user_ids
+    may be lists or comma-separated strings, audience_size defaults to the
+    number of user_ids.
+    """
+    publishers = payload['publishers']
+    if not isinstance(publishers, str):
+        publishers = ','.join(map(str, publishers))
+    user_ids = payload['user_ids']
+    if isinstance(user_ids, str):
+        user_ids = user_ids.split(',') if user_ids else []
+    user_ids = np.asarray(user_ids, dtype=np.int32)
+
+    return {
+        'cpm': float(payload['cpm']),
+        'hour_start': int(payload['hour_start']),
+        'hour_end': int(payload['hour_end']),
+        'publishers': publishers,
+        'audience_size': int(payload.get('audience_size', len(user_ids))),
+        'user_ids': user_ids,
+    }
+
+
+class ForecastService:
+    """
+    Keeps the models and feature state in memory and micro-batches concurrent
+    requests: the first waiting campaign opens a batch, which is scored as soon
+    as it holds `max_batch` campaigns or `max_delay_ms` has passed.
+    """
+
+    def __init__(self, models, user_matrix, auction_index,
+                 max_batch=DEFAULT_MAX_BATCH, max_delay_ms=DEFAULT_MAX_DELAY_MS):
+        self.models = models
+        self.user_matrix = user_matrix
+        self.auction_index = auction_index
+        self.max_batch = max_batch
+        self.max_delay = max_delay_ms / 1000
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.batch_sizes = deque(maxlen=LATENCY_WINDOW)
+        self._queue = None
+        self._batcher = None
+        # Scoring runs off the event loop, one batch at a time
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        self._batcher = asyncio.create_task(self._run_batches())
+
+    async def stop(self):
+        if self._batcher is not None:
+            self._batcher.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._batcher
+            self._batcher = None
+        self._executor.shutdown()
+
+    async def forecast(self, campaign):
+        if self._batcher is None:
+            raise RuntimeError('ForecastService.start() has not been awaited')
+        started = time.perf_counter()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((campaign, future))
+        result = await future
+        self.latencies.append(time.perf_counter() - started)
+        return result
+
+    async def _next_batch(self):
+        batch = [await self._queue.get()]
+        deadline = time.perf_counter() + self.max_delay
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            campaigns = [campaign for campaign, _ in batch]
+            try:
+                predictions = await loop.run_in_executor(self._executor, self._score, campaigns)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.batch_sizes.append(len(batch))
+            for (_, future), row in zip(batch, predictions.to_dict('records')):
+                if not future.done():
+                    future.set_result(row)
+
+    def _score(self, campaigns):
+        tasks = pd.DataFrame(campaigns)
+        return predict_batch(self.models, tasks, self.user_matrix, self.auction_index)[TARGET_COLS]
+
+    def stats(self):
+        latencies_ms = 1000 * np.array(self.latencies)
+        return {
+            'requests': len(latencies_ms),
+            'p50_ms': float(np.percentile(latencies_ms, 50)) if len(latencies_ms) else None,
+            'p99_ms': float(np.percentile(latencies_ms, 99)) if len(latencies_ms) else None,
+            'mean_batch_size': float(np.mean(self.batch_sizes)) if self.batch_sizes else None,
+        }
+
+
+async def _write_response(writer, status, body, keep_alive):
+    data = json.dumps(body).encode()
+    head = (f'HTTP/1.1 {status.value} {status.phrase}\r\n'
+            'Content-Type: application/json\r\n'
+            f'Content-Length: {len(data)}\r\n'
+            f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n')
+    writer.write(head.encode() + data)
+    await writer.drain()
+
+
+async def handle_connection(service, reader, writer):
+    """
+    Minimal HTTP/1.1 with keep-alive:
+    POST /forecast with a JSON campaign, GET /stats, GET /health
+    """
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            headers = {}
+            while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            try:
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                content_length = int(headers.get('content-length', 0))
+                if content_length < 0:
+                    raise ValueError(f'negative Content-Length {content_length}')
+            except ValueError as e:
+                # The stream position is unknown after a malformed request: answer and close
+                await _write_response(writer, HTTPStatus.BAD_REQUEST, {'error': f'malformed request: {e}'}, False)
+                break
+            body = await reader.readexactly(content_length)
+            keep_alive = headers.get('connection', '').lower() != 'close'
+
+            if method == 'POST' and path == '/forecast':
+                try:
+                    campaign = parse_campaign(json.loads(body))
+                except (ValueError, KeyError, TypeError) as e:
+                    await _write_response(writer, HTTPStatus.BAD_REQUEST, {'error': str(e)}, keep_alive)
+                else:
+                    try:
+                        forecast = await service.forecast(campaign)
+                    except Exception as e:
+                        # A scoring failure answers this request and keeps the connection usable
+                        await _write_response(writer, HTTPStatus.INTERNAL_SERVER_ERROR, {'error': str(e)},
+                                              keep_alive)
+                    else:
+                        await _write_response(writer, HTTPStatus.OK, forecast, keep_alive)
+            elif method == 'GET' and path == '/stats':
+                await _write_response(writer, HTTPStatus.OK, service.stats(), keep_alive)
+            elif method == 'GET' and path == '/health':
+                await _write_response(writer, HTTPStatus.OK, {'status': 'ok'}, keep_alive)
+            else:
+                await _write_response(writer, HTTPStatus.NOT_FOUND, {'error': f'{method} {path}'}, keep_alive)
+
+            if not keep_alive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(service, host, port):
+    await service.start()
+    server = await asyncio.start_server(lambda r, w: handle_connection(service, r, w), host, port)
+    print(f"Serving forecasts on http://{host}:{port}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await service.stop()
+        print(f"Latency: {service.stats()}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Ad views forecasting service')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--models', default=DEFAULT_MODELS_PATH, help='models saved by main.py')
+    parser.add_argument('--max-batch', type=int, default=DEFAULT_MAX_BATCH,
+                        help='most campaigns scored in one model call')
+    parser.add_argument('--max-delay-ms', type=float, default=DEFAULT_MAX_DELAY_MS,
+                        help='how long a batch waits for more campaigns')
+    parser.add_argument('--streaming', action='store_true',
+                        help='use the features of a streaming-mode run of main.py')
+    parser.add_argument('--partition-mb', type=float, default=DEFAULT_PARTITION_MB,
+                        help='partition size of that streaming-mode run')
+    parser.add_argument('--user-features', default=None,
+                        help='user features refreshed by user_state.py (default: the stage cache)')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    print("Loading models and features...")
+    models = load_models(args.models)
+    user_matrix, auction_index = load_feature_state(args.streaming, args.partition_mb, args.user_features)
+    service = ForecastService(models, user_matrix, auction_index, args.max_batch, args.max_delay_ms)
+
+    with contextlib.suppress(KeyboardInterrupt):
+        asyncio.run(serve(service, args.host, args.port))
+
+
+if __name__ == "__main__":
+    main()
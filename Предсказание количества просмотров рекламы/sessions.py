@@ -0,0 +1,51 @@
+import numpy as np
+
+SESSION_GAP_HOURS = 6  # A new session starts after more than 6 hours without impressions
+
+
+def sort_by_user_hour(user_codes, hours):
+    """Stable (user, hour) ordering of impressions"""
+    return np.lexsort((np.asarray(hours), np.asarray(user_codes)))
+
+
+def session_starts(user_codes, hours, gap=SESSION_GAP_HOURS):
+    """
+    Boolean mask of impressions opening a new session.
+    Input must already be sorted by (user, hour).
+    """
+    user_codes = np.asarray(user_codes)
+    hours = np.asarray(hours, dtype=np.int64)
+
+    starts = np.empty(len(hours), dtype=bool)
+    starts[:1] = True
+    starts[1:] = (user_codes[1:] != user_codes[:-1]) | (np.diff(hours) > gap)
+    return starts
+
+
+def global_session_ids(user_codes, hours, gap=SESSION_GAP_HOURS):
+    """
+    Compact int64 session id, unique across all users (0, 1, 2, ...).
+    Input must already be sorted by (user, hour).
+    """
+    return np.cumsum(session_starts(user_codes, hours, gap), dtype=np.int64) - 1
+
+
+def user_session_numbers(user_codes, session_ids):
+    """1-based session number within each user, for (user, hour)-sorted input"""
+    user_codes = np.asarray(user_codes)
+    user_starts = np.empty(len(user_codes), dtype=bool)
+    user_starts[:1] = True
+    user_starts[1:] = user_codes[1:] != user_codes[:-1]
+
+    first_session = np.maximum.accumulate(np.where(user_starts, session_ids, 0))
+    return session_ids - first_session + 1
+
+
+def segment_sessions(user_codes, hours, gap=SESSION_GAP_HOURS):
+    """
+    Sort impressions by (user, hour) and split them into sessions.
+    Returns (order, session_ids) where session_ids follow the sorted order.
+    """
+    order = sort_by_user_hour(user_codes, hours)
+    session_ids = global_session_ids(np.asarray(user_codes)[order], np.asarray(hours)[order], gap)
+    return order, session_ids
@@ -0,0 +1,268 @@
+import json
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from auction import HOURS_PER_DAY
+from sessions import SESSION_GAP_HOURS, global_session_ids, segment_sessions
+
+TARGET_THRESHOLDS = {'at_least_one': 1, 'at_least_two': 2, 'at_least_three': 3}
+
+
+class SimulationTables:
+    """
+    Read-only per-user tables the simulator draws from:
+    how often a user is active in each hour of day and how their
+    impressions split across publishers.
+    """
+
+    def __init__(self, user_ids, active_hour_counts, publisher_counts, publishers, hour_min, hour_max,
+                 session_counts=None):
+        self.user_ids = np.asarray(user_ids)
+        self.active_hour_counts = np.asarray(active_hour_counts, dtype=np.float32)
+        self.publisher_counts = np.asarray(publisher_counts, dtype=np.float32)
+        active_hours = self.active_hour_counts.sum(axis=1)
+        self.session_counts = active_hours if session_counts is None else \
+            np.asarray(session_counts, dtype=np.float32)
+        self.publishers = list(publishers)
+        self.hour_min = int(hour_min)
+        self.hour_max = int(hour_max)
+
+        history_days = max((self.hour_max - self.hour_min + 1) / HOURS_PER_DAY, 1.0)
+        # P(user has at least one impression in a given clock hour)
+        self.hour_activity = np.clip(self.active_hour_counts / history_days, 0, 1)
+        totals = self.publisher_counts.sum(axis=1, keepdims=True)
+        self.publisher_share = self.publisher_counts / np.maximum(totals, 1)
+        # Average number of impressions (auctions) in an hour the user is active
+        self.impressions_per_hour = totals[:, 0] / np.maximum(active_hours, 1)
+        # Share of active hours that open a session (1 / active hours per session)
+        self.session_share = np.clip(self.session_counts / np.maximum(active_hours, 1), 0, 1)
+
+        # Population averages for audience members without any history
+        self.default_hour_activity = np.zeros(HOURS_PER_DAY, dtype=np.float32)
+        self.default_publisher_share = np.zeros(len(self.publishers), dtype=np.float32)
+        self.default_impressions_per_hour = 1.0
+        self.default_session_share = 1.0
+        if len(self.user_ids):
+            self.default_hour_activity = self.hour_activity.mean(axis=0)
+            self.default_publisher_share = self.publisher_share.mean(axis=0)
+            self.default_impressions_per_hour = float(self.impressions_per_hour.mean())
+            self.default_session_share = float(self.session_share.mean())
+
+    @classmethod
+    def from_history(cls, history):
+        """Build from a preprocessed history (needs hour_of_day)"""
+        user_ids, user_idx = np.unique(history['user_id'].to_numpy(), return_inverse=True)
+        user_idx = user_idx.astype(np.int64)
+        n_users = len(user_ids)
+        hour = history['hour'].to_numpy().astype(np.int64)
+        hour_min, hour_max = (int(hour.min()), int(hour.max())) if len(hour) else (0, 0)
+
+        # Count distinct active hours, not impressions, per user and hour of day
+        active = np.unique(user_idx * (hour_max - hour_min + 1) + (hour - hour_min))
+        active_user = active // (hour_max - hour_min + 1)
+        active_hod = (active % (hour_max - hour_min + 1) + hour_min) % HOURS_PER_DAY
+        active_hour_counts = np.bincount(active_user * HOURS_PER_DAY + active_hod,
+                                         minlength=n_users * HOURS_PER_DAY).reshape(n_users, HOURS_PER_DAY)
+
+        publisher = history['publisher'].astype('category')
+        publishers = [str(pub) for pub in publisher.cat.categories]
+        codes = publisher.cat.codes.to_numpy().astype(np.int64)
+        publisher_counts = np.bincount(user_idx * len(publishers) + codes,
+                                       minlength=n_users * len(publishers)).reshape(n_users, len(publishers))
+
+        # Sessions per user, from the preprocessed global session ids when present
+        if 'session' in history.columns:
+            _, first_rows = np.unique(history['session'].to_numpy(), return_index=True)
+            session_user = user_idx[first_rows]
+        else:
+            order, session = segment_sessions(user_idx, hour)
+            session_user = user_idx[order][np.flatnonzero(np.diff(session, prepend=-1))]
+        session_counts = np.bincount(session_user, minlength=n_users)
+
+        return cls(user_ids, active_hour_counts, publisher_counts, publishers, hour_min, hour_max, session_counts)
+
+    @classmethod
+    def concat(cls, parts):
+        """Combine tables built from user-disjoint history partitions"""
+        parts = [part for part in parts if len(part.user_ids)]
+        user_ids = np.concatenate([part.user_ids for part in parts])
+        order = np.argsort(user_ids, kind='stable')
+        return cls(user_ids[order],
+                   np.concatenate([part.active_hour_counts for part in parts])[order],
+                   np.concatenate([part.publisher_counts for part in parts])[order],
+                   parts[0].publishers,
+                   min(part.hour_min for part in parts),
+                   max(part.hour_max for part in parts),
+                   np.concatenate([part.session_counts for part in parts])[order])
+
+    _ARRAYS = ['user_ids', 'active_hour_counts', 'publisher_counts', 'session_counts',
+               'hour_activity', 'publisher_share', 'impressions_per_hour', 'session_share',
+               'default_hour_activity', 'default_publisher_share']
+
+    def save(self, directory):
+        """Save the tables as .npy files so other processes can memory-map them"""
+        os.makedirs(directory, exist_ok=True)
+        for name in self._ARRAYS:
+            np.save(os.path.join(directory, f'{name}.npy'), getattr(self, name))
+        meta = {'publishers': self.publishers, 'hour_min': self.hour_min, 'hour_max': self.hour_max,
+                'default_impressions_per_hour': self.default_impressions_per_hour,
+                'default_session_share': self.default_session_share}
+        with open(os.path.join(directory, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        """Memory-map saved tables, including the derived rates, without recomputing anything"""
+        tables = cls.__new__(cls)
+        for name in cls._ARRAYS:
+            setattr(tables, name, np.load(os.path.join(directory, f'{name}.npy'), mmap_mode=mmap_mode))
+        with open(os.path.join(directory, 'meta.json'), encoding='utf-8') as f:
+            tables.__dict__.update(json.load(f))
+        return tables
+
+    def user_rows(self, user_ids):
+        """Row of each user in the tables, -1 for users without history"""
+        user_ids = np.asarray(user_ids)
+        if len(self.user_ids) == 0:
+            return np.full(len(user_ids), -1)
+        pos = np.minimum(np.searchsorted(self.user_ids, user_ids), len(self.user_ids) - 1)
+        return np.where(self.user_ids[pos] == user_ids, pos, -1)
+
+    def publisher_columns(self, publishers):
+        lookup = {pub: col for col, pub in enumerate(self.publishers)}
+        return np.array([lookup.get(str(pub), -1) for pub in publishers], dtype=np.int64)
+
+    def audience_rates(self, user_ids, columns, win):
+        """
+        Per-user rates of an audience, falling back to the population averages
+        for users without history. Returns (hour_activity, show_probability,
+        session_share) where show_probability[u, h] is the chance that an active
+        hour h of user u contains a won impression on the campaign publishers
+        (`columns` and `win` as returned by campaign_win_table).
+        """
+        rows = self.user_rows(user_ids)
+        has_history = rows >= 0
+        safe_rows = np.maximum(rows, 0)
+        hour_activity = np.where(has_history[:, None], self.hour_activity[safe_rows], self.default_hour_activity)
+        publisher_share = np.where(has_history[:, None], self.publisher_share[safe_rows],
+                                   self.default_publisher_share)
+        impressions_per_hour = np.where(has_history, self.impressions_per_hour[safe_rows],
+                                        self.default_impressions_per_hour)
+        session_share = np.where(has_history, self.session_share[safe_rows], self.default_session_share)
+
+        impression_win = np.clip(publisher_share[:, columns] @ win, 0, 1)
+        show_probability = 1 - (1 - impression_win) ** impressions_per_hour[:, None]
+        return hour_activity, show_probability, session_share
+
+
+def count_session_views(active, shown, gap=SESSION_GAP_HOURS):
+    """
+    Count views per user under the session rule: an ad is shown at most once
+    per session, and a session ends after more than `gap` hours of inactivity.
+    `active` and `shown` are (users x hours) boolean matrices.
+    """
+    user, hour = np.nonzero(active)  # Row-major, i.e. already sorted by (user, hour)
+    session = global_session_ids(user, hour, gap)
+    viewed_sessions = np.unique(session[shown[user, hour]])
+
+    first_row_of_session = np.searchsorted(session, viewed_sessions)
+    return np.bincount(user[first_row_of_session], minlength=active.shape[0])
+
+
+def campaign_win_table(tables, auction_index, cpm, publishers):
+    """
+    Table columns of the campaign publishers and their per-impression win
+    probability at each hour of day, shape (publishers, 24)
+    """
+    columns = tables.publisher_columns(publishers)
+    publishers = [pub for pub, col in zip(publishers, columns) if col >= 0]
+    hod = np.arange(HOURS_PER_DAY)
+    win = auction_index.impression_win_probability(
+        np.repeat(publishers, HOURS_PER_DAY), np.full(len(publishers) * HOURS_PER_DAY, cpm),
+        np.tile(hod, len(publishers))).reshape(len(publishers), HOURS_PER_DAY)
+    return columns[columns >= 0], win
+
+
+def simulate_campaign(tables, columns, win, hour_start, hour_end, user_ids, rng, max_users=None):
+    """
+    Monte-Carlo views of one campaign for its (optionally sampled) audience.
+    Every user x hour of the campaign window is drawn in one vectorized step.
+    Returns an array with the number of views per simulated user.
+    """
+    user_ids = np.asarray(user_ids)
+    if max_users is not None and len(user_ids) > max_users:
+        user_ids = rng.choice(user_ids, max_users, replace=False)
+    if len(user_ids) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    hour_activity, show_probability, _ = tables.audience_rates(user_ids, columns, win)
+
+    window_hod = np.arange(hour_start, hour_end + 1) % HOURS_PER_DAY
+    active = rng.random((len(user_ids), len(window_hod))) < hour_activity[:, window_hod]
+    shown = active & (rng.random(active.shape) < show_probability[:, window_hod])
+
+    return count_session_views(active, shown)
+
+
+def view_fractions(views):
+    """Share of users with at least one/two/three views"""
+    if len(views) == 0:
+        return {target: 0.0 for target in TARGET_THRESHOLDS}
+    return {target: float(np.mean(views >= threshold)) for target, threshold in TARGET_THRESHOLDS.items()}
+
+
+# Tables of the current worker process, memory-mapped once by _init_worker
+_worker_tables = None
+
+
+def _init_worker(tables_dir):
+    global _worker_tables
+    _worker_tables = SimulationTables.load(tables_dir)
+
+
+def _simulate_task(job):
+    idx, seed, columns, win, hour_start, hour_end, user_ids, max_users = job
+    rng = np.random.default_rng([seed, idx])
+    views = simulate_campaign(_worker_tables, columns, win, hour_start, hour_end, user_ids, rng, max_users)
+    return {'idx': idx, **view_fractions(views)}
+
+
+def simulate_campaigns(tasks, tables, auction_index, max_campaigns=None, max_users=None, seed=42, n_jobs=1):
+    """
+    Simulate view fractions for validate-format tasks.
+
+    Every task draws from its own generator seeded by (seed, task index), so
+    results are reproducible and do not depend on `n_jobs`. With n_jobs > 1
+    the tables are saved as .npy files once and memory-mapped by each worker
+    instead of being pickled with every task.
+    """
+    task_index = tasks.index
+    if max_campaigns is not None and len(task_index) > max_campaigns:
+        task_index = np.random.default_rng(seed).choice(task_index, max_campaigns, replace=False)
+
+    jobs = []
+    for idx in task_index:
+        task = tasks.loc[idx]
+        columns, win = campaign_win_table(tables, auction_index, task['cpm'], task['publishers'].split(','))
+        jobs.append((int(idx), seed, columns, win, task['hour_start'], task['hour_end'], task['user_ids'],
+                     max_users))
+
+    global _worker_tables
+    if n_jobs == 1:
+        _worker_tables = tables
+        simulated_results = [_simulate_task(job) for job in tqdm(jobs, desc="Simulating ad campaigns")]
+    else:
+        with tempfile.TemporaryDirectory() as tables_dir:
+            tables.save(tables_dir)
+            with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker,
+                                     initargs=(tables_dir,)) as executor:
+                chunksize = max(1, len(jobs) // (4 * (n_jobs or os.cpu_count() or 1)))
+                simulated_results = list(tqdm(executor.map(_simulate_task, jobs, chunksize=chunksize),
+                                              total=len(jobs), desc="Simulating ad campaigns"))
+
+    return pd.DataFrame(simulated_results, columns=['idx'] + list(TARGET_THRESHOLDS))
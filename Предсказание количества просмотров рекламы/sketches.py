@@ -0,0 +1,185 @@
+from concurrent.futures import ProcessPoolExecutor
+from functools import reduce
+
+import numpy as np
+import pandas as pd
+
+from auction import HOURS_PER_DAY, impression_win_probability_from_counts
+
+# Log-spaced CPM bins shared by all CPM sketches: any CPM in a bin is within
+# CPM_RELATIVE_ACCURACY of the bin's representative value
+CPM_RELATIVE_ACCURACY = 0.01
+CPM_BIN_GAMMA = (1 + CPM_RELATIVE_ACCURACY) / (1 - CPM_RELATIVE_ACCURACY)
+CPM_MIN, CPM_MAX = 1e-2, 1e6
+CPM_MIN_KEY = int(np.ceil(np.log(CPM_MIN) / np.log(CPM_BIN_GAMMA)))
+N_CPM_BINS = int(np.ceil(np.log(CPM_MAX) / np.log(CPM_BIN_GAMMA))) - CPM_MIN_KEY + 1
+
+# CPM percentiles at which analyze_auction_dynamics reports win probabilities
+ANALYSIS_PERCENTILES = [0, 10, 25, 50, 75, 90, 95, 99, 100]
+
+
+def cpm_bins(cpm):
+    """Log-spaced bin of each CPM, 0 .. N_CPM_BINS - 1"""
+    cpm = np.clip(np.asarray(cpm, dtype=np.float64), CPM_MIN, CPM_MAX)
+    return np.ceil(np.log(cpm) / np.log(CPM_BIN_GAMMA)).astype(np.int64) - CPM_MIN_KEY
+
+
+def cpm_bin_values(bins):
+    """Representative CPM of each bin"""
+    return 2 * CPM_BIN_GAMMA ** (np.asarray(bins) + CPM_MIN_KEY) / (CPM_BIN_GAMMA + 1)
+
+
+class CpmSketch:
+    """
+    Mergeable DDSketch-style CPM sketch for every publisher x hour-of-day cell.
+
+    Each cell keeps log-binned CPM counts plus exact count, sum, sum of squares,
+    min and max. Sketches built from disjoint slices of history (in parallel or
+    as new data arrives) merge by adding the bins, and quantiles come out within
+    CPM_RELATIVE_ACCURACY of the exact value.
+    """
+
+    def __init__(self, publishers=(), bin_counts=None, sums=None, sums_sq=None, cpm_min=None, cpm_max=None):
+        self.publishers = [str(pub) for pub in publishers]
+        n_cells = len(self.publishers) * HOURS_PER_DAY
+        self.bin_counts = np.zeros((n_cells, N_CPM_BINS), dtype=np.int64) if bin_counts is None else bin_counts
+        self.sums = np.zeros(n_cells) if sums is None else sums
+        self.sums_sq = np.zeros(n_cells) if sums_sq is None else sums_sq
+        self.cpm_min = np.full(n_cells, np.inf) if cpm_min is None else cpm_min
+        self.cpm_max = np.full(n_cells, -np.inf) if cpm_max is None else cpm_max
+        self._cum_counts = None
+
+    @classmethod
+    def from_history(cls, history):
+        """One pass over a history slice (needs publisher, hour_of_day, cpm)"""
+        publisher = history['publisher'].astype('category')
+        publishers = [str(pub) for pub in publisher.cat.categories]
+        n_cells = len(publishers) * HOURS_PER_DAY
+
+        cell = (publisher.cat.codes.to_numpy().astype(np.int64) * HOURS_PER_DAY
+                + history['hour_of_day'].to_numpy().astype(np.int64))
+        cpm = history['cpm'].to_numpy().astype(np.float64)
+
+        bin_counts = np.bincount(cell * N_CPM_BINS + cpm_bins(cpm),
+                                 minlength=n_cells * N_CPM_BINS).reshape(n_cells, N_CPM_BINS)
+        sums = np.bincount(cell, weights=cpm, minlength=n_cells)
+        sums_sq = np.bincount(cell, weights=cpm ** 2, minlength=n_cells)
+        cpm_min = np.full(n_cells, np.inf)
+        cpm_max = np.full(n_cells, -np.inf)
+        np.minimum.at(cpm_min, cell, cpm)
+        np.maximum.at(cpm_max, cell, cpm)
+        return cls(publishers, bin_counts, sums, sums_sq, cpm_min, cpm_max)
+
+    def _cells_for(self, publishers):
+        """Rows of this sketch's publisher x hour cells laid out for another publisher list"""
+        lookup = {pub: pos for pos, pub in enumerate(self.publishers)}
+        target = np.array([lookup[pub] for pub in publishers], dtype=np.int64)
+        return (target[:, None] * HOURS_PER_DAY + np.arange(HOURS_PER_DAY)).reshape(-1)
+
+    def merge(self, other):
+        """Sketch of the union of both slices of history"""
+        publishers = sorted(set(self.publishers) | set(other.publishers))
+        merged = CpmSketch(publishers)
+        for part in (self, other):
+            cells = merged._cells_for(part.publishers)
+            merged.bin_counts[cells] += part.bin_counts
+            merged.sums[cells] += part.sums
+            merged.sums_sq[cells] += part.sums_sq
+            merged.cpm_min[cells] = np.minimum(merged.cpm_min[cells], part.cpm_min)
+            merged.cpm_max[cells] = np.maximum(merged.cpm_max[cells], part.cpm_max)
+        return merged
+
+    def update(self, history):
+        """Fold a new slice of history into the sketch"""
+        self.__dict__.update(self.merge(CpmSketch.from_history(history)).__dict__)
+
+    @property
+    def counts(self):
+        return self.bin_counts.sum(axis=1)
+
+    def quantiles(self, q):
+        """q-quantile of every cell (linear interpolation like np.percentile), NaN for empty cells"""
+        cum = np.cumsum(self.bin_counts, axis=1)
+        total = cum[:, -1]
+        position = q * np.maximum(total - 1, 0)
+
+        def value_at_rank(rank):
+            values = cpm_bin_values((cum > rank[:, None]).argmax(axis=1))
+            # Both ends are tracked exactly
+            values = np.where(rank <= 0, self.cpm_min, values)
+            return np.where(rank >= total - 1, self.cpm_max, values)
+
+        lower, upper = np.floor(position), np.ceil(position)
+        lower_value = value_at_rank(lower)
+        values = lower_value + (value_at_rank(upper) - lower_value) * (position - lower)
+        return np.where(total > 0, values, np.nan)
+
+    def _cells(self, publishers, hour_of_day):
+        lookup = {pub: pos for pos, pub in enumerate(self.publishers)}
+        codes = np.array([lookup.get(str(pub), -1) for pub in publishers], dtype=np.int64)
+        return np.where(codes >= 0, codes * HOURS_PER_DAY + np.asarray(hour_of_day, dtype=np.int64), -1)
+
+    def win_counts(self, publishers, hour_of_day, cpm):
+        """
+        (higher_count, equal_count, total_count) of historical bids per query,
+        where "equal" means the same CPM bin. Answered from per-cell prefix sums.
+        """
+        cells = self._cells(publishers, hour_of_day)
+        known = cells >= 0
+        if not known.any():
+            zeros = np.zeros(len(cells), dtype=np.int64)
+            return zeros, zeros, zeros
+        if self._cum_counts is None:
+            self._cum_counts = np.concatenate([np.zeros((len(self.bin_counts), 1), dtype=np.int64),
+                                               np.cumsum(self.bin_counts, axis=1)], axis=1)
+        safe_cells = np.maximum(cells, 0)
+        bins = cpm_bins(cpm)
+
+        total = np.where(known, self._cum_counts[safe_cells, -1], 0)
+        below = self._cum_counts[safe_cells, bins]
+        through = self._cum_counts[safe_cells, bins + 1]
+        return np.where(known, total - through, 0), np.where(known, through - below, 0), total
+
+    def win_probability(self, publishers, hour_of_day, cpm):
+        """README auction rule against the sketched historical bids of each publisher x hour"""
+        return impression_win_probability_from_counts(*self.win_counts(publishers, hour_of_day, cpm))
+
+    def _cell_labels(self, cells):
+        return [self.publishers[cell // HOURS_PER_DAY] for cell in cells], cells % HOURS_PER_DAY
+
+    def stats(self):
+        """Per publisher x hour CPM mean/median/std/count of the non-empty cells"""
+        counts = self.counts
+        cells = np.flatnonzero(counts)
+        n = counts[cells]
+        mean = self.sums[cells] / n
+        with np.errstate(invalid='ignore', divide='ignore'):
+            std = np.where(n > 1, np.sqrt(np.maximum(self.sums_sq[cells] - self.sums[cells] * mean, 0) / (n - 1)),
+                           np.nan)
+        publishers, hour_of_day = self._cell_labels(cells)
+        return pd.DataFrame({'publisher': publishers, 'hour_of_day': hour_of_day, 'mean': mean,
+                             'median': self.quantiles(0.5)[cells], 'std': std, 'count': n})
+
+    def win_probability_table(self, percentiles=ANALYSIS_PERCENTILES, min_count=100):
+        """Win probability at representative CPM percentiles of every cell with more than `min_count` bids"""
+        cells = np.flatnonzero(self.counts > min_count)
+        cpm = np.stack([self.quantiles(p / 100)[cells] for p in percentiles], axis=1)
+        publishers, hour_of_day = self._cell_labels(cells)
+
+        table = pd.DataFrame({'publisher': np.repeat(publishers, len(percentiles)),
+                              'hour_of_day': np.repeat(hour_of_day, len(percentiles)),
+                              'cpm': cpm.reshape(-1)}).drop_duplicates(ignore_index=True)
+        table['win_probability'] = self.win_probability(table['publisher'], table['hour_of_day'], table['cpm'])
+        return table
+
+
+def build_cpm_sketch(history, n_jobs=1):
+    """Build the sketch of a history frame, split into `n_jobs` slices sketched in parallel and merged"""
+    if n_jobs is None or n_jobs <= 1 or len(history) < 2 * n_jobs:
+        return CpmSketch.from_history(history)
+
+    bounds = np.linspace(0, len(history), n_jobs + 1).astype(np.int64)
+    columns = history[['publisher', 'hour_of_day', 'cpm']]
+    slices = [columns.iloc[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])]
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        return reduce(CpmSketch.merge, executor.map(CpmSketch.from_history, slices))
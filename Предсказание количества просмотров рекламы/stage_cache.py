@@ -0,0 +1,128 @@
+import glob
+import hashlib
+import json
+import os
+import pickle
+from contextlib import nullcontext
+
+import pandas as pd
+
+try:
+    import pyarrow  # noqa: F401  (enables the Parquet format for DataFrames)
+    HAS_PARQUET = True
+except ImportError:
+    HAS_PARQUET = False
+
+CACHE_VERSION = 3
+DEFAULT_CACHE_DIR = os.path.join('artifacts', 'stage_cache')
+
+
+def file_fingerprint(path):
+    """Cheap fingerprint of an input file: name, size and modification time"""
+    if not os.path.exists(path):
+        return [os.path.basename(path), None, None]
+    stat = os.stat(path)
+    return [os.path.basename(path), stat.st_size, stat.st_mtime_ns]
+
+
+class Stage:
+    """
+    A pipeline stage whose output is loaded from the cache or computed on first
+    access of `.value`. The key only depends on input file fingerprints, stage
+    parameters and upstream keys, so stages whose output is cached never force
+    their upstream stages to be computed.
+    """
+
+    def __init__(self, cache, name, compute, inputs=(), params=None, upstream=()):
+        self.cache = cache
+        self.name = name
+        self.compute = compute
+        self.upstream = list(upstream)
+        self.invalidated = name in cache.invalidate or 'all' in cache.invalidate or \
+            any(stage.invalidated for stage in self.upstream)
+
+        payload = {
+            'version': CACHE_VERSION,
+            'stage': name,
+            'inputs': [file_fingerprint(path) for path in inputs],
+            'params': params or {},
+            'upstream': [stage.key for stage in self.upstream],
+        }
+        self.key = hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()[:16]
+        self._value = None
+        self._loaded = False
+
+    @property
+    def value(self):
+        if not self._loaded:
+            self._value = self.cache.load_or_compute(self)
+            self._loaded = True
+        return self._value
+
+
+class StageCache:
+    """
+    On-disk cache of pipeline stage outputs, one entry per stage. Loading or
+    computing a stage is measured by the optional profiler (a profiling.StageProfiler).
+    """
+
+    def __init__(self, root=DEFAULT_CACHE_DIR, invalidate=(), enabled=True, profiler=None):
+        self.root = root
+        self.invalidate = set(invalidate or ())
+        self.enabled = enabled
+        self.profiler = profiler
+        if enabled:
+            os.makedirs(root, exist_ok=True)
+
+    def stage(self, name, compute, inputs=(), params=None, upstream=()):
+        return Stage(self, name, compute, inputs, params, upstream)
+
+    def _base_path(self, stage):
+        return os.path.join(self.root, f'{stage.name}-{stage.key}')
+
+    def load_or_compute(self, stage):
+        with self.profiler.stage(stage.name) if self.profiler else nullcontext({}) as record:
+            value = self._load_or_compute(stage, record)
+            record['rows'] = len(value) if isinstance(value, pd.DataFrame) else None
+        return value
+
+    def _load_or_compute(self, stage, record):
+        base = self._base_path(stage)
+        if self.enabled and not stage.invalidated:
+            value = self._load(base)
+            if value is not None:
+                print(f"Loaded stage '{stage.name}' from cache")
+                record['cached'] = True
+                return value
+
+        value = stage.compute()
+        if self.enabled:
+            self._remove_entries(stage.name)
+            self._save(value, base)
+        return value
+
+    def _remove_entries(self, name):
+        for path in glob.glob(os.path.join(self.root, f'{glob.escape(name)}-*')):
+            os.remove(path)
+
+    @staticmethod
+    def _save(value, base):
+        if HAS_PARQUET and isinstance(value, pd.DataFrame):
+            value.to_parquet(base + '.parquet')
+            with open(base + '.attrs.json', 'w', encoding='utf-8') as f:
+                json.dump(value.attrs, f)
+        else:
+            with open(base + '.pkl', 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def _load(base):
+        if os.path.exists(base + '.parquet'):
+            value = pd.read_parquet(base + '.parquet')
+            with open(base + '.attrs.json', encoding='utf-8') as f:
+                value.attrs.update(json.load(f))
+            return value
+        if os.path.exists(base + '.pkl'):
+            with open(base + '.pkl', 'rb') as f:
+                return pickle.load(f)
+        return None
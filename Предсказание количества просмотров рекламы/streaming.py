@@ -0,0 +1,134 @@
+import json
+import math
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from auction import AuctionIndex
+from history_store import read_history_tsv
+from simulation import SimulationTables
+from sketches import CpmSketch
+
+DEFAULT_PARTITION_MB = 256
+DEFAULT_CHUNK_ROWS = 1_000_000
+DEFAULT_WORK_DIR = os.path.join('artifacts', 'history_partitions')
+
+# On-disk layout of one partition: one raw binary file per column
+PARTITION_DTYPES = {
+    'hour': np.int32,
+    'cpm': np.float32,
+    'publisher': np.int16,
+    'user_id': np.int32,
+}
+
+
+def partition_history(path='history.tsv', work_dir=DEFAULT_WORK_DIR,
+                      partition_mb=DEFAULT_PARTITION_MB, chunk_rows=DEFAULT_CHUNK_ROWS):
+    """
+    Stream history.tsv in chunks and hash-partition rows by user_id into
+    `work_dir`, so every user's impressions end up in exactly one partition.
+    The number of partitions grows with the file size, which keeps the
+    size of each partition (and peak memory when processing it) constant.
+    """
+    n_partitions = max(1, math.ceil(os.path.getsize(path) / (partition_mb * 1024 ** 2)))
+
+    shutil.rmtree(work_dir, ignore_errors=True)
+    for part in range(n_partitions):
+        os.makedirs(os.path.join(work_dir, f'part_{part:04d}'))
+
+    publisher_codes = {}
+    for chunk in read_history_tsv(path, chunksize=chunk_rows):
+        # Chunks have their own categories; map them onto one global publisher code
+        chunk_labels = [str(pub) for pub in chunk['publisher'].cat.categories]
+        lookup = np.array([publisher_codes.setdefault(pub, len(publisher_codes)) for pub in chunk_labels],
+                          dtype=PARTITION_DTYPES['publisher'])
+        columns = {
+            'hour': chunk['hour'].to_numpy(),
+            'cpm': chunk['cpm'].to_numpy(),
+            'publisher': lookup[chunk['publisher'].cat.codes.to_numpy()],
+            'user_id': chunk['user_id'].to_numpy(),
+        }
+
+        part_of_row = columns['user_id'] % n_partitions
+        order = np.argsort(part_of_row, kind='stable')
+        bounds = np.searchsorted(part_of_row[order], np.arange(n_partitions + 1))
+        for part in range(n_partitions):
+            rows = order[bounds[part]:bounds[part + 1]]
+            if len(rows) == 0:
+                continue
+            for col, dtype in PARTITION_DTYPES.items():
+                with open(os.path.join(work_dir, f'part_{part:04d}', f'{col}.bin'), 'ab') as f:
+                    columns[col][rows].astype(dtype, copy=False).tofile(f)
+
+    meta = {'partitions': n_partitions, 'publishers': list(publisher_codes)}
+    with open(os.path.join(work_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    return n_partitions
+
+
+def iter_partitions(work_dir=DEFAULT_WORK_DIR):
+    """Yield each partition of a partitioned history as a DataFrame"""
+    with open(os.path.join(work_dir, 'meta.json'), encoding='utf-8') as f:
+        meta = json.load(f)
+
+    for part in range(meta['partitions']):
+        part_dir = os.path.join(work_dir, f'part_{part:04d}')
+        if not os.path.exists(os.path.join(part_dir, 'hour.bin')):
+            continue
+        columns = {col: np.fromfile(os.path.join(part_dir, f'{col}.bin'), dtype=dtype)
+                   for col, dtype in PARTITION_DTYPES.items()}
+        columns['publisher'] = pd.Categorical.from_codes(columns['publisher'], categories=meta['publishers'])
+        yield pd.DataFrame(columns)
+
+
+def _merge_cpm_counts(cpm_counts, history):
+    """Fold one partition into the running (publisher, hour_of_day, cpm) value counts"""
+    part_counts = (history.groupby(['publisher', 'hour_of_day', 'cpm'], observed=True)
+                   .size().rename('count').reset_index())
+    part_counts['publisher'] = part_counts['publisher'].astype(str)
+    if cpm_counts is None:
+        return part_counts
+    merged = pd.concat([cpm_counts, part_counts], ignore_index=True)
+    return merged.groupby(['publisher', 'hour_of_day', 'cpm'], as_index=False)['count'].sum()
+
+
+def stream_history_features(preprocess, aggregate, path='history.tsv', work_dir=DEFAULT_WORK_DIR,
+                            partition_mb=DEFAULT_PARTITION_MB, chunk_rows=DEFAULT_CHUNK_ROWS):
+    """
+    Out-of-core counterpart of preprocess_history + create_user_features +
+    analyze_auction_dynamics. Each user-partition is preprocessed (sessions
+    never cross partitions) and aggregated on its own; only per-user rows and
+    the CPM value counts and sketches are kept between partitions.
+
+    Returns ((user_activity, histograms, histogram_columns), cpm_stats, auction_index, simulation_tables).
+    """
+    n_partitions = partition_history(path, work_dir, partition_mb, chunk_rows)
+    print(f"History split into {n_partitions} user partitions")
+
+    activity_parts = []
+    histograms = None
+    table_parts = []
+    cpm_counts = None
+    sketch = CpmSketch()
+    session_offset = 0
+    for history in iter_partitions(work_dir):
+        history = preprocess(history)
+        if 'session' in history.columns:
+            # Keep global session ids unique across partitions
+            history['session'] += session_offset
+            session_offset = int(history['session'].max()) + 1
+        user_activity, part_histograms, histogram_columns = aggregate(history)
+        activity_parts.append(user_activity)
+        # Histogram rows are keyed by the global user index, so partitions simply add up
+        histograms = part_histograms if histograms is None else histograms + part_histograms
+        table_parts.append(SimulationTables.from_history(history))
+        cpm_counts = _merge_cpm_counts(cpm_counts, history)
+        sketch = sketch.merge(CpmSketch.from_history(history))
+
+    user_activity = pd.concat(activity_parts, ignore_index=True)
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+    return ((user_activity, histograms, histogram_columns), sketch.stats(), AuctionIndex.from_counts(cpm_counts),
+            SimulationTables.concat(table_parts))
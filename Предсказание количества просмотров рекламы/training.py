@@ -0,0 +1,174 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from catboost import CatBoostRegressor, Pool
+
+from metrics import TARGET_COLUMNS
+
+# Name of the single MultiRMSE model fitted on conditional ratios of the three targets
+MULTI_TARGET = 'multi'
+
+# Training data of the current worker process, set once by _init_worker
+_worker_data = None
+
+
+def _init_worker(X, targets, cat_features):
+    global _worker_data
+    _worker_data = X, targets, cat_features
+
+
+class ConstantColumnsModel:
+    """
+    Multi-target model whose target columns that were constant in training are
+    predicted as that constant: MultiRMSE refuses to train when any column is
+    constant, so CatBoost only fits the other columns (if there are any)
+    """
+
+    def __init__(self, model, constants, feature_names, cat_feature_indices):
+        self.model = model
+        self.constants = constants  # Value of each constant column, NaN for the fitted ones
+        self.feature_names_ = feature_names
+        self.cat_feature_indices = cat_feature_indices
+
+    def get_cat_feature_indices(self):
+        return self.cat_feature_indices
+
+    def get_feature_importance(self):
+        if self.model is None:
+            return np.zeros(len(self.feature_names_))
+        return self.model.get_feature_importance()
+
+    def predict(self, X):
+        n_rows = X.num_row() if isinstance(X, Pool) else len(X)
+        preds = np.tile(self.constants, (n_rows, 1))
+        if self.model is not None:
+            fitted = np.isnan(self.constants)
+            preds[:, fitted] = np.asarray(self.model.predict(X)).reshape(n_rows, -1)
+        return preds
+
+
+def _fit_constant_columns(X, y, train_rows, val_rows, cat_features, params, constant):
+    """Fit a multi-target job whose labels have constant columns in the training rows"""
+    constants = np.where(constant, y.iloc[train_rows].iloc[0].to_numpy(dtype=np.float64), np.nan)
+    model = None
+    if not constant.all():
+        varying = y.columns[~constant]
+        train_pool = Pool(X.iloc[train_rows], y[varying].iloc[train_rows], cat_features=cat_features)
+        val_pool = Pool(X.iloc[val_rows], y[varying].iloc[val_rows], cat_features=cat_features)
+        model = CatBoostRegressor(**params)
+        model.fit(train_pool, eval_set=val_pool, early_stopping_rounds=50)
+    return ConstantColumnsModel(model, constants, list(X.columns), list(cat_features))
+
+
+def _fit_job(job):
+    """Fit one CatBoost model on the worker's copy of the training data"""
+    target, fold, train_rows, val_rows, params = job
+    X, targets, cat_features = _worker_data
+    y = targets[target]
+
+    started = time.perf_counter()
+    if isinstance(y, pd.DataFrame):
+        constant = (y.iloc[train_rows].nunique() <= 1).to_numpy()
+        if constant.any():
+            model = _fit_constant_columns(X, y, train_rows, val_rows, cat_features, params, constant)
+            return {'target': target, 'fold': fold, 'model': model, 'val_preds': model.predict(X.iloc[val_rows]),
+                    'seconds': time.perf_counter() - started}
+
+    # Both Pools are built once and reused for fitting, early stopping and validation predictions
+    train_pool = Pool(X.iloc[train_rows], y.iloc[train_rows], cat_features=cat_features)
+    val_pool = Pool(X.iloc[val_rows], y.iloc[val_rows], cat_features=cat_features)
+
+    model = CatBoostRegressor(**params)
+    model.fit(train_pool, eval_set=val_pool, early_stopping_rounds=50)
+    return {'target': target, 'fold': fold, 'model': model, 'val_preds': model.predict(val_pool),
+            'seconds': time.perf_counter() - started}
+
+
+def _run_jobs(X, targets, cat_features, jobs, workers):
+    """Fit `jobs` in this process (workers <= 1) or in a process pool; returns (results, wall seconds)"""
+    started = time.perf_counter()
+    if workers <= 1:
+        _init_worker(X, targets, cat_features)
+        results = [_fit_job(job) for job in jobs]
+    else:
+        thread_count = max(1, (os.cpu_count() or 1) // workers)
+        # Workers must not write to the same catboost_info directory
+        jobs = [(target, fold, train_rows, val_rows,
+                 {**params, 'thread_count': thread_count, 'allow_writing_files': False})
+                for target, fold, train_rows, val_rows, params in jobs]
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(X, targets, cat_features)) as executor:
+            results = list(executor.map(_fit_job, jobs))
+    return results, time.perf_counter() - started
+
+
+def fit_catboost_jobs(X, targets, cat_features, jobs, n_jobs=1, label='CatBoost fits', measure_speedup=False):
+    """
+    Run (target, fold, train_rows, val_rows, params) fitting jobs, concurrently
+    when n_jobs > 1. `targets` maps each job target to its labels (a Series, or
+    a DataFrame for multi-target models). Each worker process receives the
+    training data once; the machine's cores are split between the workers
+    through thread_count. With `measure_speedup` the jobs are fitted a second
+    time one after another, with all cores each, and the wall-clock speedup
+    over that sequential run is reported. Returns one result dict per job, in job order.
+    """
+    workers = min(n_jobs or 1, len(jobs))
+    results, wall = _run_jobs(X, targets, cat_features, jobs, workers)
+
+    fit_seconds = sum(result['seconds'] for result in results)
+    # Summed job time over wall-clock time is how many jobs ran at once on average, and
+    # efficiency is that per worker. Neither is a speedup over --jobs 1: jobs sharing the
+    # cores through thread_count run slower than they would alone.
+    concurrency = fit_seconds / max(wall, 1e-9)
+    print(f"{label}: {len(results)} models on {workers} worker(s) in {wall:.1f}s wall-clock, "
+          f"{fit_seconds:.1f}s summed job time (concurrency {concurrency:.2f}, "
+          f"parallel efficiency {concurrency / workers:.0%})")
+
+    if measure_speedup and workers > 1:
+        _, sequential_wall = _run_jobs(X, targets, cat_features, jobs, 1)
+        print(f"{label}: {sequential_wall:.1f}s wall-clock one job at a time, "
+              f"speedup {sequential_wall / max(wall, 1e-9):.2f}x on {workers} workers")
+    return results
+
+
+def conditional_ratios(targets):
+    """
+    (at_least_one, at_least_two / at_least_one, at_least_three / at_least_two):
+    every ratio lies in [0, 1], whatever the size of the targets
+    """
+    values = targets[TARGET_COLUMNS].to_numpy(dtype=np.float64)
+    ratios = values.copy()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ratios[:, 1:] = np.where(values[:, :-1] > 0, values[:, 1:] / values[:, :-1], 0)
+    return pd.DataFrame(ratios, columns=[f'{target}_ratio' for target in TARGET_COLUMNS], index=targets.index)
+
+
+def chain_ratios(ratios):
+    """Inverse of conditional_ratios: cumulative products of the clipped ratios, so one >= two >= three"""
+    return np.cumprod(np.clip(ratios, 0, 1), axis=1)
+
+
+def _model_input(model, features):
+    X = features[model.feature_names_]
+    if not model.get_cat_feature_indices():
+        # A plain float matrix skips CatBoost's column-by-column DataFrame conversion
+        X = X.to_numpy(dtype=np.float32)
+    return X
+
+
+def predict_targets(models, features):
+    """
+    at_least_* predictions of the models returned by train_models, clipped to
+    [0, 1]. The multi-target model predicts conditional ratios, which are
+    chained into a non-increasing triple.
+    """
+    if MULTI_TARGET in models:
+        model = models[MULTI_TARGET]
+        return pd.DataFrame(chain_ratios(model.predict(_model_input(model, features))),
+                            columns=TARGET_COLUMNS, index=features.index)
+
+    return pd.DataFrame({target: np.clip(models[target].predict(_model_input(models[target], features)), 0, 1)
+                         for target in TARGET_COLUMNS if target in models}, index=features.index)
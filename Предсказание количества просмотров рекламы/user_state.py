@@ -0,0 +1,290 @@
+import argparse
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from auction import HOURS_PER_DAY
+from history_store import read_history_tsv
+from main import CPM_RANGE_BINS, CPM_RANGE_LABELS, assemble_user_features
+from sessions import SESSION_GAP_HOURS, sort_by_user_hour
+from sketches import N_CPM_BINS, cpm_bin_values, cpm_bins
+
+DEFAULT_STATE_PATH = os.path.join('artifacts', 'user_state.pkl')
+DEFAULT_FEATURES_PATH = os.path.join('artifacts', 'user_features.pkl')
+
+# Additive per-user columns of the state matrices, followed by one column per
+# publisher of the state's fixed publisher vocabulary
+SUM_COLUMNS = ['count', 'cpm_sum', 'cpm_sumsq', 'session_starts']
+HOUR_OFFSET = len(SUM_COLUMNS)
+WEEKDAY_OFFSET = HOUR_OFFSET + HOURS_PER_DAY
+CPM_RANGE_OFFSET = WEEKDAY_OFFSET + 7
+CPM_BIN_OFFSET = CPM_RANGE_OFFSET + len(CPM_RANGE_LABELS)
+PUBLISHER_OFFSET = CPM_BIN_OFFSET + N_CPM_BINS
+
+
+class UserActivityState:
+    """
+    Mergeable per-user activity aggregates, kept per day so that new history
+    partitions are folded in and old days leave a sliding window without
+    re-reading the rest of the history.
+
+    Counts, sums, sums of squares, histograms and a log-binned CPM histogram
+    (for the median) are additive sparse matrices, one per day plus their
+    running total. CPM min/max are kept per day and only recomputed for users
+    seen on expired days. Partitions must arrive in time order: sessions
+    continue from each user's last impression.
+
+    The publisher vocabulary is fixed when the state is built, so the
+    publisher_<p>_count columns keep matching the models trained on them.
+    Impressions on other publishers count towards every aggregate except the
+    publisher histogram.
+    """
+
+    def __init__(self, user_ids, publishers, window_days=None):
+        self.user_index = pd.Index(np.asarray(user_ids))
+        self.window_days = window_days
+        self.publishers = sorted({str(pub) for pub in publishers})  # Sorted like user_histograms
+        self.unknown_publisher_impressions = 0
+        self.days = {}  # day -> {'stats': csr, 'rows', 'cpm_min', 'cpm_max'}
+
+        n_users = len(self.user_index)
+        self.totals = sparse.csr_matrix((n_users, self.n_columns))
+        self.cpm_min = np.full(n_users, np.inf)
+        self.cpm_max = np.full(n_users, -np.inf)
+        self.last_hour = np.full(n_users, np.iinfo(np.int64).min // 2, dtype=np.int64)
+
+    @property
+    def n_columns(self):
+        return PUBLISHER_OFFSET + len(self.publishers)
+
+    def _publisher_columns(self, publishers):
+        """State column of each impression's publisher, -1 outside the vocabulary"""
+        publishers = publishers.astype(str).astype('category')
+        lookup = {pub: PUBLISHER_OFFSET + pos for pos, pub in enumerate(self.publishers)}
+        columns = np.array([lookup.get(pub, -1) for pub in publishers.cat.categories], dtype=np.int64)
+        publisher_cols = columns[publishers.cat.codes.to_numpy()]
+        self.unknown_publisher_impressions += int((publisher_cols < 0).sum())
+        return publisher_cols
+
+    def update(self, history):
+        """Fold a raw history partition (hour, cpm, publisher, user_id) into the state"""
+        rows = self.user_index.get_indexer(history['user_id'])
+        known = rows >= 0
+        history = history[known]
+        rows = rows[known]
+        hour = history['hour'].to_numpy().astype(np.int64)
+        cpm = history['cpm'].to_numpy().astype(np.float64)
+        publisher_cols = self._publisher_columns(history['publisher'])
+
+        order = sort_by_user_hour(rows, hour)
+        rows, hour, cpm, publisher_cols = rows[order], hour[order], cpm[order], publisher_cols[order]
+
+        # Session starts, continuing each user's last session from earlier partitions
+        first_of_user = np.ones(len(rows), dtype=bool)
+        first_of_user[1:] = rows[1:] != rows[:-1]
+        previous_hour = np.empty_like(hour)
+        previous_hour[1:] = hour[:-1]
+        previous_hour[first_of_user] = self.last_hour[rows[first_of_user]]
+        session_starts = hour - previous_hour > SESSION_GAP_HOURS
+        np.maximum.at(self.last_hour, rows, hour)
+
+        cpm_range = pd.cut(cpm, bins=CPM_RANGE_BINS, labels=False)
+        cpm_range_cols = np.where(np.isnan(cpm_range), -1,
+                                  CPM_RANGE_OFFSET + np.nan_to_num(cpm_range)).astype(np.int64)
+        day = hour // HOURS_PER_DAY
+        for d in np.unique(day):
+            sel = day == d
+            entries = [
+                (0, 1.0), (1, cpm[sel]), (2, cpm[sel] ** 2), (3, session_starts[sel].astype(np.float64)),
+                (HOUR_OFFSET + hour[sel] % HOURS_PER_DAY, 1.0),
+                (WEEKDAY_OFFSET + (d + 3) % 7, 1.0),
+                (cpm_range_cols[sel], 1.0),
+                (CPM_BIN_OFFSET + cpm_bins(cpm[sel]), 1.0),
+                (publisher_cols[sel], 1.0),
+            ]
+            self._add_day(int(d), rows[sel], cpm[sel], entries)
+
+        self._expire()
+
+    def _add_day(self, day, rows, cpm, entries):
+        n = len(rows)
+        cols = np.concatenate([np.broadcast_to(col, n) for col, _ in entries])
+        data = np.concatenate([np.broadcast_to(np.asarray(value, dtype=np.float64), n) for _, value in entries])
+        valid = cols >= 0  # CPMs outside the CPM range bins, publishers outside the vocabulary
+        stats = sparse.csr_matrix((data[valid], (np.tile(rows, len(entries))[valid], cols[valid])),
+                                  shape=(len(self.user_index), self.n_columns))
+        self.totals = self.totals + stats
+
+        # rows are sorted, so per-user min/max are segment reductions
+        user_starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+        day_rows = rows[user_starts]
+        day_min = np.minimum.reduceat(cpm, user_starts)
+        day_max = np.maximum.reduceat(cpm, user_starts)
+        np.minimum.at(self.cpm_min, day_rows, day_min)
+        np.maximum.at(self.cpm_max, day_rows, day_max)
+
+        if day in self.days:
+            block = self.days[day]
+            block['stats'] = block['stats'] + stats
+            day_rows = np.concatenate([block['rows'], day_rows])
+            day_min = np.concatenate([block['cpm_min'], day_min])
+            day_max = np.concatenate([block['cpm_max'], day_max])
+            day_rows, inverse = np.unique(day_rows, return_inverse=True)
+            merged_min = np.full(len(day_rows), np.inf)
+            merged_max = np.full(len(day_rows), -np.inf)
+            np.minimum.at(merged_min, inverse, day_min)
+            np.maximum.at(merged_max, inverse, day_max)
+            day_min, day_max = merged_min, merged_max
+            stats = block['stats']
+        self.days[day] = {'stats': stats, 'rows': day_rows, 'cpm_min': day_min, 'cpm_max': day_max}
+
+    def _expire(self):
+        """Drop days that fell out of the sliding window"""
+        if self.window_days is None or not self.days:
+            return
+        cutoff = max(self.days) - self.window_days + 1
+        expired = [day for day in self.days if day < cutoff]
+        if not expired:
+            return
+
+        affected = np.unique(np.concatenate([self.days[day]['rows'] for day in expired]))
+        for day in expired:
+            self.totals = self.totals - self.days.pop(day)['stats']
+        self.totals.eliminate_zeros()
+
+        # Min/max cannot be subtracted: recompute them for the affected users only
+        self.cpm_min[affected] = np.inf
+        self.cpm_max[affected] = -np.inf
+        for block in self.days.values():
+            sel = np.isin(block['rows'], affected)
+            np.minimum.at(self.cpm_min, block['rows'][sel], block['cpm_min'][sel])
+            np.maximum.at(self.cpm_max, block['rows'][sel], block['cpm_max'][sel])
+
+    def _median_cpm(self, bins):
+        """Approximate median CPM of each row of a CSR matrix of bin counts"""
+        cum = np.cumsum(bins.data)
+        before_row = np.concatenate([[0], cum])[bins.indptr[:-1]]
+        count = np.asarray(bins.sum(axis=1)).ravel()
+
+        def value_at_rank(rank):
+            pos = np.searchsorted(cum, before_row + rank - 0.5)
+            return cpm_bin_values(bins.indices[np.minimum(pos, len(bins.indices) - 1)])
+
+        # Mean of the two middle values for even counts, like pandas
+        return (value_at_rank((count + 1) // 2) + value_at_rank(count // 2 + 1)) / 2
+
+    def activity(self):
+        """
+        Current aggregates in the format of aggregate_user_activity:
+        (user_activity, histograms, histogram_columns)
+        """
+        totals = self.totals.tocsc()
+        count = totals[:, 0].toarray().ravel()
+        active = np.flatnonzero(count > 0.5)
+        count = count[active]
+        cpm_sum, cpm_sumsq, starts = (totals[:, col].toarray().ravel()[active] for col in (1, 2, 3))
+
+        mean = cpm_sum / count
+        with np.errstate(invalid='ignore', divide='ignore'):
+            std = np.where(count > 1, np.sqrt(np.maximum(cpm_sumsq - cpm_sum * mean, 0) / (count - 1)), np.nan)
+        cpm_bin_counts = totals[:, CPM_BIN_OFFSET:PUBLISHER_OFFSET].tocsr()[active]
+        cpm_bin_counts.sort_indices()
+
+        user_activity = pd.DataFrame({
+            'user_id': self.user_index[active],
+            'hour_count': count.astype(np.int64),
+            'cpm_mean': mean,
+            'cpm_median': self._median_cpm(cpm_bin_counts),
+            'cpm_std': std,
+            'cpm_min': self.cpm_min[active],
+            'cpm_max': self.cpm_max[active],
+            'session_id_nunique': np.rint(starts).astype(np.int64),
+        })
+
+        # Same column layout as user_histograms: publishers (sorted), hours, weekdays, CPM ranges
+        blocks = [
+            ('publisher', self.publishers, PUBLISHER_OFFSET + np.arange(len(self.publishers))),
+            ('hour', list(range(HOURS_PER_DAY)), HOUR_OFFSET + np.arange(HOURS_PER_DAY)),
+            ('weekday', list(range(7)), WEEKDAY_OFFSET + np.arange(7)),
+            ('cpm_range', CPM_RANGE_LABELS, CPM_RANGE_OFFSET + np.arange(len(CPM_RANGE_LABELS))),
+        ]
+        histogram_columns = [f'{prefix}_{value}_count' for prefix, values, _ in blocks for value in values]
+        histograms = totals[:, np.concatenate([cols for _, _, cols in blocks])].tocsr()
+        histograms.data = np.rint(histograms.data)
+        histograms = histograms.astype(np.int32)
+        histograms.eliminate_zeros()
+        return user_activity, histograms, histogram_columns
+
+    def save(self, path=DEFAULT_STATE_PATH):
+        """
+        Pickle the attributes as a plain dict: a pickled instance would refer to
+        __main__.UserActivityState when saved by this script's CLI
+        """
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'wb') as f:
+            pickle.dump(dict(self.__dict__), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path=DEFAULT_STATE_PATH):
+        with open(path, 'rb') as f:
+            attributes = pickle.load(f)
+        state = cls.__new__(cls)
+        state.__dict__.update(attributes)
+        return state
+
+
+def history_publishers(paths):
+    """Publishers seen in history TSV files, read one column at a time"""
+    publishers = set()
+    for path in paths:
+        publishers.update(pd.read_csv(path, sep='\t', usecols=['publisher'], dtype=str)['publisher'])
+    return publishers
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Fold new history partitions into the per-user feature state')
+    parser.add_argument('history', nargs='+', help='new history TSV partitions, in time order')
+    parser.add_argument('--state', default=DEFAULT_STATE_PATH, help='stored state (created if missing)')
+    parser.add_argument('--publishers-from', default=None, metavar='USER_FEATURES',
+                        help='when building a new state, take the publisher vocabulary from these pickled '
+                             'user features (the ones the models were trained on); default: the publishers '
+                             'of the given partitions')
+    parser.add_argument('--window-days', type=int, default=None,
+                        help='keep only the latest N days of history (default: all)')
+    parser.add_argument('--output', default=DEFAULT_FEATURES_PATH, help='where to write the refreshed user features')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    users = pd.read_csv('users.tsv', sep='\t', dtype={'user_id': np.int32})
+
+    if os.path.exists(args.state):
+        state = UserActivityState.load(args.state)
+        if args.window_days is not None:
+            state.window_days = args.window_days
+    else:
+        if args.publishers_from is not None:
+            publishers = pd.read_pickle(args.publishers_from).attrs['publishers']
+        else:
+            publishers = history_publishers(args.history)
+        state = UserActivityState(users['user_id'], publishers, window_days=args.window_days)
+
+    for path in args.history:
+        print(f"Folding {path} into the user state...")
+        state.update(read_history_tsv(path))
+    state.save(args.state)
+    if state.unknown_publisher_impressions:
+        print(f"{state.unknown_publisher_impressions} impressions on publishers outside the state's "
+              f"vocabulary were left out of the publisher histograms")
+
+    user_features = assemble_user_features(users, *state.activity())
+    pd.to_pickle(user_features, args.output)
+    print(f"User features saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()